@@ -9,8 +9,9 @@
 # ----------------------------------------------------------------
 
 # system libraries
-import os, sys, time, traceback, operator
-from time import gmtime, strftime
+import os, sys, time, traceback, calendar
+import itertools, mmap, hashlib, multiprocessing
+from time import gmtime, strftime, sleep
 from datetime import datetime, timedelta
 from optparse import OptionParser
 import glob
@@ -28,7 +29,6 @@ import matplotlib.pyplot as plt
 from matplotlib import colors
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 from mpl_toolkits.basemap import Basemap as Basemap
-import matplotlib.patheffects as PathEffects
 
 # mathematical libraries
 import numpy as np
@@ -42,16 +42,18 @@ RAD_TO_DEG = 180/pi
 
 # Tiles support
 try:
-  from PIL import Image, ImageDraw, ImageChops
+  from PIL import Image, ImageDraw, ImageChops, ImageFont, ImageFilter
 except:
-  import Image, ImageDraw, ImageChops
-import urllib
+  import Image, ImageDraw, ImageChops, ImageFont, ImageFilter
+import urlparse, httplib, threading, sqlite3
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 
 # Mongodb
 global dbSupport
 try:
   import pymongo
-  from collections import OrderedDict
   dbSupport = True
 except:
   dbSupport = False
@@ -98,6 +100,17 @@ maxDelayBetweenReadings = 2*60*60 # 2 hour is suspect (split)
 maxDistanceBetweenReadings = 200*binSize # 20 km is suspect
 debugMode = False
 maxDataColumns = 15 # only process the 15 first columns from CSV
+logBlockSize = 65536 # number of log lines parsed at once
+logLineSize = 80 # average log line length in bytes (buffer preallocation)
+logCacheEnabled = True # keep the parsed logs in logCacheFolder
+logCacheFolder = os.path.join(tempfile.gettempdir(), "bgeigie_cache")
+logCacheMaxSize = 256*1024*1024 # bytes, least recently used logs are removed first
+logCacheVersion = 2 # increase when the parsing rules change (invalidate the cache)
+dbBatchSize = 1000 # readings per bulk insert
+dbCursorBatchSize = 10000 # documents per database round trip when reading
+summaryStoreEnabled = True # update the persistent per cell summary with each log
+summaryCellSize = 0.001 # degrees (about 100 m), cell size of the persistent summary
+summaryParameters = (True, False, False, False, False, True, False) # parsing options of the summary logs (uSv, Japan, 60s CPM)
 
 gridSizeCropW = -15
 gridSizeCropH = -15
@@ -260,6 +273,23 @@ def distance_on_unit_sphere(lat1, long1, lat2, long2):
   except:
     return 0
 
+# Same as distance_on_unit_sphere but working on numpy arrays
+def distance_on_unit_sphere_array(lat1, long1, lat2, long2):
+    degrees_to_radians = math.pi/180.0
+
+    phi1 = (90.0 - lat1)*degrees_to_radians
+    phi2 = (90.0 - lat2)*degrees_to_radians
+    theta1 = long1*degrees_to_radians
+    theta2 = long2*degrees_to_radians
+
+    cos = (np.sin(phi1) * np.sin(phi2) * np.cos(theta1 - theta2) +
+           np.cos(phi1) * np.cos(phi2))
+    with np.errstate(invalid='ignore'):
+      arc = np.arccos(np.clip(cos, -1.0, 1.0))
+
+    # math.acos domain error returns 0 in the scalar version
+    return np.where(np.abs(cos) > 1.0, 0, arc * 6373) # 6373 for km
+
 # -----------------------------------------------------------------------------
 # Compute latitude/longitude offset
 # -----------------------------------------------------------------------------
@@ -293,372 +323,1381 @@ def seconds_difference(stamp1, stamp2):
     return 24*60*60*delta.days + delta.seconds
 
 # -----------------------------------------------------------------------------
-# Compute checksum
+# Format epoch timestamps (vectorized)
 # -----------------------------------------------------------------------------
-def get_checksum(line):
-    return reduce(operator.xor, map(ord, line[1:]))
+JSTOffset = 9 # GMT+9 from Zulu time
+
+def formatEpoch(times, hours = 0, dateSeparator = "-", timeSeparator = "T"):
+    # Same as strftime("%Y-%m-%dT%H:%M:%S") with custom separators
+    text = np.datetime_as_string((np.asarray(times, dtype=np.int64) + hours*3600).astype("datetime64[s]")).astype("S19")
+    chars = text.view(np.uint8).reshape(len(text), 19)
+    chars[:, [4, 7]] = ord(dateSeparator)
+    chars[:, 10] = ord(timeSeparator)
+    return text
+
+def epochToDatetime(t):
+    return datetime.utcfromtimestamp(int(t))
 
 # -----------------------------------------------------------------------------
-# Split bGeigie raw log file
-# TODO: to be merged to loadLogFile
+# Columnar bGeigie log parser
 # -----------------------------------------------------------------------------
-@trace(debugMode)
-def splitLogFile(filename, timeSplit, distanceSplit, worldMode, ignoreDelay, ignoreDistance, fixChecksum = False):
-  # Load the bGeigie log file
-  bg = open(filename, "r")
-  lines = bg.readlines()
-  bg.close()
-
-  # Initialize log counter
-  logCounter = 1
-  dlasttime = 0
-  blastlat = 0
-  blastlon = 0
-  logBaseName = os.path.splitext(filename)[0]
-  newFilename = "%s_%03d.LOG" % (logBaseName,logCounter)
-  newFiles = []
+# bGeigie Log format
+# header + id + time + cpm + cp5s + totc + rnStatus + latitude + northsouthindicator + longitude + eastwestindicator + altitude + gpsStatus + dop + quality
+bgeigieModels = {"$BMRDD": "bGeigieMini", "$BGRDD": "bGeigieClassic", "$BNRDD": "bGeigieNano"}
+maxLineLength = 512 # longer lines are considered as garbage (header issue)
+
+# Hexadecimal digit lookup table (-1 = not an hexadecimal digit)
+hexTable = np.array([int(chr(c), 16) if chr(c) in "0123456789abcdefABCDEF" else -1 for c in range(256)], dtype=np.int16)
+
+# Characters ignored by int() around the checksum value
+checksumBlanks = np.zeros(256, dtype=bool)
+checksumBlanks[[0, ord(" "), ord("\t"), ord("\r"), ord("\n"), ord("*")]] = True
+
+def linesToMatrix(lines):
+    # Pack text lines into a zero padded byte matrix (one row per line)
+    width = max(16, max([0]+map(len, lines)))
+    if width > maxLineLength:
+      lines = [l if len(l) <= maxLineLength else "" for l in lines]
+      width = maxLineLength
+    text = np.array(lines, dtype="S%d" % width)
+    return text.view(np.uint8).reshape(len(lines), width)
+
+def fieldMatrix(mat, starts, ends):
+    # Extract the [starts, ends) bytes of each row, zero padded
+    widths = ends - starts
+    width = max(1, widths.max()) if len(widths) else 1
+    offsets = np.arange(width)
+    inside = offsets < widths[:, None]
+    index = np.where(inside, starts[:, None] + offsets, 0)
+    field = np.where(inside, mat[np.arange(len(mat))[:, None], index], 0).astype(np.uint8)
+    return field, widths
+
+def matrixStrings(field):
+    return np.ascontiguousarray(field).view("S%d" % field.shape[1]).ravel()
+
+def fieldStrings(mat, starts, ends):
+    return matrixStrings(fieldMatrix(mat, starts, ends)[0])
+
+def stringsToFloat(values):
+    # Bulk conversion, falling back to per value conversion on invalid entries
+    try:
+      return values.astype(np.float64), np.ones(len(values), dtype=bool)
+    except ValueError:
+      result = np.zeros(len(values))
+      valid = np.ones(len(values), dtype=bool)
+      for i, v in enumerate(values):
+        try:
+          result[i] = float(v)
+        except ValueError:
+          valid[i] = False
+      return result, valid
+
+def days_from_civil(y, m, d):
+    # from http://howardhinnant.github.io/date_algorithms.html
+    y = y - (m <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * (m + np.where(m > 2, -3, 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+def parseTimes(field, widths):
+    # Convert fixed format '%Y-%m-%dT%H:%M:%SZ' timestamps to epoch seconds
+    epoch = np.zeros(len(field), dtype=np.int64)
+    valid = np.zeros(len(field), dtype=bool)
+    if not len(field) or field.shape[1] < 20:
+      return epoch, valid
+
+    digits = field[:, :20].astype(np.int64) - ord("0")
+    valid = (widths == 20)
+    for i, c in ((4, "-"), (7, "-"), (10, "T"), (13, ":"), (16, ":"), (19, "Z")):
+      valid &= field[:, i] == ord(c)
+    for i in (0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18):
+      valid &= (digits[:, i] >= 0) & (digits[:, i] <= 9)
+
+    year = digits[:, 0]*1000 + digits[:, 1]*100 + digits[:, 2]*10 + digits[:, 3]
+    month = digits[:, 5]*10 + digits[:, 6]
+    day = digits[:, 8]*10 + digits[:, 9]
+    hour = digits[:, 11]*10 + digits[:, 12]
+    minute = digits[:, 14]*10 + digits[:, 15]
+    second = digits[:, 17]*10 + digits[:, 18]
+
+    # Same ranges as datetime
+    leap = ((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0)
+    monthDays = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31, 31])[np.clip(month - 1, 0, 12)] + (leap & (month == 2))
+    valid &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1) & (day <= monthDays)
+    valid &= (hour < 24) & (minute < 60) & (second < 60)
+
+    epoch = days_from_civil(year, month, day) * 86400 + hour*3600 + minute*60 + second
+    return np.where(valid, epoch, 0), valid
+
+def headerRows(mat):
+    # Rows starting with a known bGeigie header
+    header = np.zeros(len(mat), dtype=bool)
+    for h in bgeigieModels.keys():
+      header |= (mat[:, :7] == np.frombuffer(h+",", dtype=np.uint8)).all(axis=1)
+    return header
+
+def locateColumns(mat, header):
+    # Start/end positions of the first columns (comma separated)
+    commas = mat == ord(",")
+    counts = commas.sum(axis=1)
+    r = np.flatnonzero(header & (counts >= maxDataColumns-1))
+    positions = np.nonzero(commas[r])[1]
+    firstComma = np.cumsum(counts[r]) - counts[r]
+    ends = positions[firstComma[:, None] + np.arange(maxDataColumns-1)].reshape(len(r), maxDataColumns-1)
+    starts = np.concatenate((np.zeros((len(r), 1), dtype=ends.dtype), ends[:, :-1]+1), axis=1)
+    return r, starts, ends
+
+def flagColumn(mat, r, starts, ends, column, value):
+    # Single character column check
+    return (ends[:, column]-starts[:, column] == 1) & (mat[r, starts[:, column]] == ord(value))
+
+def parseTimeColumn(mat, r, starts, ends):
+    timeField, timeWidths = fieldMatrix(mat[r], starts[:, 2], ends[:, 2])
+    times, valid = parseTimes(timeField, timeWidths)
+    for i in np.flatnonzero(~valid):
+      # Unusual format, let strptime decide
+      try:
+        date = matrixStrings(timeField[i:i+1])[0]
+        times[i] = calendar.timegm(datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ').timetuple())
+        valid[i] = True
+      except ValueError:
+        pass
+    return times, valid
+
+def parsePositionColumns(mat, r, starts, ends):
+    sub = mat[r]
+    lat, latValid = stringsToFloat(fieldStrings(sub, starts[:, 7], ends[:, 7]))
+    lon, lonValid = stringsToFloat(fieldStrings(sub, starts[:, 9], ends[:, 9]))
+
+    # Convert from GPS format (DDDMM.MMMM..) to decimal degrees
+    lat = np.abs(lat)/100
+    lon = np.abs(lon)/100
+    lon = ((lon-np.trunc(lon))/60)*100+np.trunc(lon)
+    lat = ((lat-np.trunc(lat))/60)*100+np.trunc(lat)
+    lat = np.where(flagColumn(mat, r, starts, ends, 8, "S"), -lat, lat)
+    lon = np.where(flagColumn(mat, r, starts, ends, 10, "W"), -lon, lon)
+    return lat, lon, latValid & lonValid
+
+def insideJapan(lat, lon):
+    return (lat >= JP_lat_min) & (lat <= JP_lat_max) & (lon >= JP_lon_min) & (lon <= JP_lon_max)
+
+class LogParser:
+    def __init__(self, enableuSv, worldMode, ignoreDelay, ignoreDistance, instantCPM, timeSplit = False, distanceSplit = False):
+        self.enableuSv = enableuSv
+        self.worldMode = worldMode
+        self.ignoreDelay = ignoreDelay
+        self.ignoreDistance = ignoreDistance
+        self.instantCPM = instantCPM
+        self.timeSplit = timeSplit and not ignoreDelay
+        self.distanceSplit = distanceSplit and not ignoreDistance
+
+        self.bgeigieModel = ""
+        self.bgeigieVersion = ""
+        self.bgeigieSerial = ""
+
+        # Drives found in the log (first line, skipped lines and dose)
+        self.segments = []
+        self._newSegment(1)
+
+        # Last drive split reference (kept between blocks)
+        self.splitLastTime = None
+        self.splitLastLat = 0
+        self.splitLastLon = 0
+
+    def _newSegment(self, firstLine):
+        self.segments.append({"line": firstLine, "dose": 0,
+                              "skipped": {"U": [], "H": [], "T": [], "D": [], "O": []}})
+        # U Unknown
+        # H Header issue
+        # T Time issue
+        # D Distance issue
+        # O Out of Japan
+
+        # Last accepted reading (kept between blocks)
+        self.lastTime = None
+        self.lastLat = 0
+        self.lastLon = 0
+
+    def model(self):
+        # Get the bgeigie model
+        if (self.bgeigieModel != ""):
+          return "%s%s %s" % (self.bgeigieModel, self.bgeigieVersion, self.bgeigieSerial)
+        return ""
+
+    def parseLines(self, lines, firstLine = 1):
+        return self.parseMatrix(linesToMatrix(lines), np.arange(firstLine, firstLine+len(lines)))
+
+    def scanMatrix(self, mat, firstLine = 1):
+        # Only look for the drives in a block of log lines
+        for c in self._splitDrives(mat):
+          self._newSegment(firstLine+c)
+
+    def parseMatrix(self, mat, lines):
+        # Parse a block of log lines (byte matrix) and return the valid readings as columns
+        cuts = self._splitDrives(mat)
+        if not len(cuts):
+          return self._parseRows(mat, lines)
+
+        results = [self._parseRows(mat[:cuts[0]], lines[:cuts[0]])]
+        for a, b in zip(cuts, cuts[1:]+[len(mat)]):
+          self._newSegment(int(lines[a]))
+          results.append(self._parseRows(mat[a:b], lines[a:b]))
+        return dict([(k, np.concatenate([c[k] for c in results])) for k in results[0].keys()])
+
+    def _splitDrives(self, mat):
+        # Same drive split rules as splitLogFile, return the rows starting a new drive
+        if not (self.timeSplit or self.distanceSplit) or not len(mat):
+          return []
+
+        # Any reading with a valid header and time (checksum is not checked)
+        r, starts, ends = locateColumns(mat, headerRows(mat))
+        valid = flagColumn(mat, r, starts, ends, 6, "A")
+        r, starts, ends = r[valid], starts[valid], ends[valid]
+        times, valid = parseTimeColumn(mat, r, starts, ends)
+        r, starts, ends, times = r[valid], starts[valid], ends[valid], times[valid]
+        if not len(r):
+          return []
+        lat, lon, valid = parsePositionColumns(mat, r, starts, ends)
+        if not self.worldMode:
+          valid &= insideJapan(lat, lon)
+
+        # Nothing suspect (most of the time), no need to go sequential
+        suspect = False
+        if self.timeSplit:
+          previous = np.concatenate(([times[0] if self.splitLastTime is None else self.splitLastTime], times[:-1]))
+          suspect |= (np.abs(times - previous) > maxDelayBetweenReadings).any()
+        if self.distanceSplit and valid.any():
+          previousLat = np.concatenate(([self.splitLastLat], lat[valid][:-1]))
+          previousLon = np.concatenate(([self.splitLastLon], lon[valid][:-1]))
+          suspect |= ((previousLat != 0) & (previousLon != 0) &
+                      (distance_on_unit_sphere_array(previousLat, previousLon, lat[valid], lon[valid]) > maxDistanceBetweenReadings)).any()
+        if not suspect:
+          self.splitLastTime = int(times[-1])
+          if valid.any():
+            self.splitLastLat, self.splitLastLon = float(lat[valid][-1]), float(lon[valid][-1])
+          return []
+
+        cuts = []
+        dlasttime, blastlat, blastlon = self.splitLastTime, self.splitLastLat, self.splitLastLon
+        for i, (dtime, blat, blon, bvalid) in enumerate(zip(times.tolist(), lat.tolist(), lon.tolist(), valid.tolist())):
+          # Check time difference between readings
+          if dlasttime is not None and self.timeSplit:
+            delta = dtime - dlasttime
+            if delta > maxDelayBetweenReadings or delta < -maxDelayBetweenReadings:
+              cuts.append(int(r[i]))
+              blastlat = 0
+              blastlon = 0
+          dlasttime = dtime
+
+          if not bvalid:
+            continue
 
-  # Overwrite first file
-  split = open(filename,"w")
+          # Too far away, split the reading
+          if (blastlon != 0) and (blastlat != 0) and self.distanceSplit:
+            if distance_on_unit_sphere(blastlat, blastlon, blat, blon) > maxDistanceBetweenReadings:
+              cuts.append(int(r[i]))
+              dlasttime = None
+          blastlat = blat
+          blastlon = blon
+
+        self.splitLastTime, self.splitLastLat, self.splitLastLon = dlasttime, blastlat, blastlon
+        return cuts
+
+    def _delayFilter(self, times, lines):
+        keep = np.ones(len(times), dtype=bool)
+        if not len(times):
+          return keep
+
+        if not self.ignoreDelay:
+          previous = np.empty_like(times)
+          previous[1:] = times[:-1]
+          previous[0] = times[0] if self.lastTime is None else self.lastTime
+          delays = times - previous
+          suspect = np.abs(delays) > maxDelayBetweenReadings
+          if suspect.any():
+            # Skipped readings don't move the reference time, check sequentially
+            start = int(np.argmax(suspect))
+            last = int(previous[start])
+            for i, t in enumerate(times[start:].tolist(), start):
+              delta = t - last
+              if delta > maxDelayBetweenReadings or delta < -maxDelayBetweenReadings:
+                print "WARNING: line %d unexpected delay between measures [%d]" % (lines[i], delta)
+                keep[i] = False
+              else:
+                last = t
+            self.lastTime = last
+            return keep
+
+        self.lastTime = int(times[-1])
+        return keep
+
+    def _distanceFilter(self, lat, lon):
+        keep = np.ones(len(lat), dtype=bool)
+        if not len(lat):
+          return keep
+
+        if not self.ignoreDistance:
+          previousLat = np.concatenate(([self.lastLat], lat[:-1]))
+          previousLon = np.concatenate(([self.lastLon], lon[:-1]))
+          suspect = ((previousLat != 0) & (previousLon != 0) &
+                     (distance_on_unit_sphere_array(previousLat, previousLon, lat, lon) > maxDistanceBetweenReadings))
+          if suspect.any():
+            # Skipped readings don't move the reference position, check sequentially
+            start = int(np.argmax(suspect))
+            blastlat, blastlon = float(previousLat[start]), float(previousLon[start])
+            for i, (blat, blon) in enumerate(zip(lat[start:].tolist(), lon[start:].tolist()), start):
+              if (blastlon != 0) and (blastlat != 0):
+                if distance_on_unit_sphere(blastlat, blastlon, blat, blon) > maxDistanceBetweenReadings:
+                  keep[i] = False
+                  continue
+              blastlat, blastlon = blat, blon
+            self.lastLat, self.lastLon = blastlat, blastlon
+            return keep
+
+        self.lastLat, self.lastLon = float(lat[-1]), float(lon[-1])
+        return keep
+
+    def _parseRows(self, mat, lines):
+        rows = np.arange(len(mat))
+        segment = self.segments[-1]
+        skipped = dict([(k, [rows[:0]]) for k in segment["skipped"].keys()])
+
+        # Comments
+        comment = mat[:, 0] == ord("#")
+        for i in np.flatnonzero(comment):
+          line = mat[i].tostring().rstrip("\0")
+          if line.find("format=") != -1:
+             # Grab bgeigie version
+             self.bgeigieVersion = " %s" % (line[line.find("format=")+7:].strip())
+
+        # Check the checksum value
+        star, original, expected = checksumMatrix(mat)
+        checksum = ~comment & (original >= 0)
+        skipped["H"].append(rows[~(comment | checksum)])
+        for i in np.flatnonzero(checksum & (original != expected)):
+          print "WARNING: line %d wrong checksum 0x%02X, expected 0x%02X" % (lines[i], original[i], expected[i])
+
+        # Check for bGeigieMini or bGeigie
+        header = headerRows(mat) & checksum
+        if self.bgeigieModel == "" and header.any():
+          self.bgeigieModel = bgeigieModels[mat[np.argmax(header), :6].tostring()]
+
+        r, starts, ends = locateColumns(mat, header)
+        valid = flagColumn(mat, r, starts, ends, 6, "A") & flagColumn(mat, r, starts, ends, 12, "A")
+        r, starts, ends = r[valid], starts[valid], ends[valid]
+        accepted = np.zeros(len(mat), dtype=bool)
+        accepted[r] = True
+        skipped["H"].append(rows[checksum & ~accepted])
+
+        # Extract serial number
+        if self.bgeigieSerial == "" and len(r):
+          self.bgeigieSerial = "(#%s)" % fieldStrings(mat[r[:1]], starts[:1, 1], ends[:1, 1])[0]
+
+        # Extract date
+        times, valid = parseTimeColumn(mat, r, starts, ends)
+        for i in np.flatnonzero(~valid):
+          print "Error in line %d: invalid date %s" % (lines[r[i]], fieldStrings(mat[r[i:i+1]], starts[i:i+1, 2], ends[i:i+1, 2])[0])
+        skipped["U"].append(r[~valid])
+        r, starts, ends, times = r[valid], starts[valid], ends[valid], times[valid]
+
+        # Check time difference between readings
+        valid = self._delayFilter(times, lines[r])
+        skipped["T"].append(r[~valid])
+        r, starts, ends, times = r[valid], starts[valid], ends[valid], times[valid]
+
+        # Extract CPM measurements
+        sub = mat[r]
+        cpm, cpmValid = stringsToFloat(fieldStrings(sub, starts[:, 3], ends[:, 3]))
+        cp5s, cp5sValid = stringsToFloat(fieldStrings(sub, starts[:, 4], ends[:, 4]))
+        altitude, altitudeValid = stringsToFloat(fieldStrings(sub, starts[:, 11], ends[:, 11]))
+        lat, lon, valid = parsePositionColumns(mat, r, starts, ends)
+        if self.instantCPM:
+          cpm, cpmValid = cp5s*12, cp5sValid
+
+        # Dose is accumulated before the position checks
+        segment["dose"] += cp5s[cpmValid & cp5sValid].sum()
+        valid &= cpmValid & cp5sValid & altitudeValid
+        for i in np.flatnonzero(~valid):
+          print "Error in line %d: invalid data %s" % (lines[r[i]], mat[r[i]].tostring().rstrip("\0").strip())
+        if self.enableuSv: cpm /= CPMfactor
+
+        # Invalid, skip the reading
+        valid &= ~(((lat == 0) & (lon == 0)) |
+                   ((lat < -90.0) | (lat > 90.0) | (lon < -180) | (lon > 180)))
+        skipped["U"].append(r[~valid])
+        keep = valid
+
+        if not self.worldMode:
+          # Outside Japan, skip the reading
+          valid = insideJapan(lat, lon)
+          skipped["O"].append(r[keep & ~valid])
+          keep &= valid
+
+        # Too far away, skip the reading
+        valid = self._distanceFilter(lat[keep], lon[keep])
+        skipped["D"].append(r[keep][~valid])
+        keep[keep] = valid
+
+        # Check if altitude is valid, clip if necessary
+        altitude = np.maximum(altitude, 0)
+        if not self.worldMode:
+          altitude = np.minimum(altitude, JP_alt_max)
+
+        for k in skipped.keys():
+          segment["skipped"][k] += np.sort(lines[np.concatenate(skipped[k])]).tolist()
+
+        return {"drive": fieldStrings(sub[keep], starts[keep, 1], ends[keep, 1]),
+                "time": times[keep],
+                "cpm": cpm[keep],
+                "cp5s": cp5s[keep],
+                "lat": lat[keep],
+                "lon": lon[keep],
+                "altitude": altitude[keep],
+                "line": lines[r[keep]],
+                "segment": np.zeros(keep.sum(), dtype=np.int32) + (len(self.segments)-1)}
 
-  # Process the log
-  for line in lines:
-    # Extract items (comma separated)
-    if line[0] == "#": # ignore comments
-       split.write("%s" % line)
-       continue
-    data = line.split(",")
+# -----------------------------------------------------------------------------
+# Streaming log reader
+# -----------------------------------------------------------------------------
+def readLogBlocks(filename, blockSize = logBlockSize):
+    # Yield (first line number, lines) blocks without loading the whole file
+    bg = open(filename, "r")
+    try:
+      lineCounter = 1
+      while True:
+        lines = list(itertools.islice(bg, blockSize))
+        if not lines:
+          break
+        yield lineCounter, lines
+        lineCounter += len(lines)
+    finally:
+      bg.close()
+
+class ReadingBuffer:
+    # Growable numpy columns (capacity doubled when full)
+    def __init__(self, capacity = logBlockSize):
+        self.capacity = max(1, int(capacity))
+        self.size = 0
+        self.columns = {}
+
+    def _grow(self, size):
+        capacity = self.capacity
+        while capacity < size:
+          capacity *= 2
+        for k, v in self.columns.items():
+          column = np.empty(capacity, dtype=v.dtype)
+          column[:self.size] = v[:self.size]
+          self.columns[k] = column
+        self.capacity = capacity
+
+    def append(self, columns):
+        n = len(columns["time"])
+        if not self.columns:
+          for k, v in columns.items():
+            self.columns[k] = np.empty(self.capacity, dtype=v.dtype)
+        if self.size + n > self.capacity:
+          self._grow(self.size + n)
+        for k, v in columns.items():
+          if v.dtype.itemsize > self.columns[k].dtype.itemsize:
+            # Wider strings than before
+            self.columns[k] = self.columns[k].astype(v.dtype)
+          self.columns[k][self.size:self.size+n] = v
+        self.size += n
+
+    def compact(self):
+        # Trim the columns to the number of readings and release the buffers
+        columns = dict([(k, v[:self.size].copy()) for k, v in self.columns.items()])
+        self.columns = {}
+        return columns
 
-    # Check and fix the checksum value
-    if fixChecksum:
-      try:
-        original = int(line.split("*")[1][:2],16)
-        expected = get_checksum(line.split("*")[0])
-        if original != expected:
-          line = "%s*%02X\n" % (line.split("*")[0], expected)
-      except:
-        pass
+# -----------------------------------------------------------------------------
+# Memory mapped log scanner
+# -----------------------------------------------------------------------------
+def bytesToMatrix(data, starts, ends):
+    # Gather lines of a byte buffer into a zero padded matrix (one row per line)
+    lengths = ends - starts
+    lengths[lengths > maxLineLength] = 0 # garbage (header issue)
+    mat = np.zeros((len(starts), max(16, lengths.max())), dtype=np.uint8)
+    for i in xrange(lengths.max()):
+      inside = lengths > i
+      mat[inside, i] = data[starts[inside] + i]
+    return mat
+
+def lineBlocks(data, blockSize = logBlockSize):
+    # Yield (starts, ends) offsets of the next blockSize lines of a byte buffer
+    size = len(data)
+    position = 0
+    while position < size:
+      # Find the next block of end of lines
+      chunk = blockSize*logLineSize
+      while True:
+        end = min(size, position+chunk)
+        ends = np.flatnonzero(data[position:end] == ord("\n"))[:blockSize] + position + 1
+        if len(ends) or end == size:
+          break
+        chunk *= 2
+      if end == size and len(ends) < blockSize and (not len(ends) or ends[-1] < size):
+        ends = np.append(ends, size) # last line without end of line
 
-    # Crop any extra columns
-    data = data[:maxDataColumns]
+      yield np.concatenate(([position], ends[:-1])), ends
+      position = int(ends[-1])
 
-    # Check for bGeigieMini or bGeigie
-    if data[0] == "$BMRDD" or data[0] == "$BGRDD" or data[0] == "$BNRDD":
-      if len(data) != maxDataColumns or data[6] != "A":
-         split.write("%s" % line)
-         continue
+def mapLogBlocks(filename, blockSize = logBlockSize):
+    # Yield (first line number, line offsets, byte matrix) blocks, no string is created per line
+    bg = open(filename, "rb")
+    try:
+      try:
+        mm = mmap.mmap(bg.fileno(), 0, access=mmap.ACCESS_READ)
+      except (EnvironmentError, ValueError):
+        # Not mappable (empty file, pipe, ...)
+        mm = None
+
+      if mm is None:
+        position = 0
+        for firstLine, lines in readLogBlocks(filename, blockSize):
+          lengths = np.array(map(len, lines), dtype=np.int64)
+          yield firstLine, position + np.cumsum(lengths) - lengths, linesToMatrix(lines)
+          position += lengths.sum()
+        return
+
+      data = np.frombuffer(mm, dtype=np.uint8)
+      try:
+        lineCounter = 1
+        for starts, ends in lineBlocks(data, blockSize):
+          yield lineCounter, starts, bytesToMatrix(data, starts, ends)
+          lineCounter += len(starts)
+      finally:
+        del data
+        mm.close()
+    finally:
+      bg.close()
+
+def copyFileRange(source, destination, start, end, bufferSize = 1 << 20):
+    source.seek(start)
+    while start < end:
+      data = source.read(min(bufferSize, end-start))
+      if not data:
+        break
+      destination.write(data)
+      start += len(data)
 
-      # Unpack the data
-      (s_header,s_id,s_time,
-       s_cpm,s_cp5s,s_totc,
-       s_rnStatus,s_latitude,s_northsouthindicator,s_longitude,s_eastwestindicator,
-       s_altitude,s_gpsStatus,s_dop,s_quality) = data
-    else:
-      # Ignore invalid data
-      split.write("%s" % line)
-      continue
+# -----------------------------------------------------------------------------
+# Bulk checksum validation and repair
+# -----------------------------------------------------------------------------
+hexDigits = np.frombuffer("0123456789ABCDEF", dtype=np.uint8)
+
+def checksumMatrix(mat):
+    # Compute the checksums of a block of lines (byte matrix)
+    # return the '*' positions, the checksums read from the lines (-1 if unreadable) and the expected ones
+    rows = np.arange(len(mat))
+    width = mat.shape[1]
+    stars = mat == ord("*")
+    star = np.argmax(stars, axis=1)
+
+    # XOR of all the characters between '$' and '*'
+    body = (np.arange(width) >= 1) & (np.arange(width) < star[:, None])
+    expected = np.bitwise_xor.reduce(mat * body, axis=1).astype(np.int16)
+
+    # Same values as int(line.split("*")[1][:2],16)
+    c1 = np.where(star+1 < width, mat[rows, np.minimum(star+1, width-1)], 0)
+    c2 = np.where(star+2 < width, mat[rows, np.minimum(star+2, width-1)], 0)
+    h1, h2 = hexTable[c1], hexTable[c2]
+    original = np.where(h2 >= 0, np.where(h1 >= 0, h1*16+h2, h2), h1)
+    valid = (stars[rows, star] & (star >= 2) &
+             (((h1 >= 0) & ((h2 >= 0) | checksumBlanks[c2])) | (checksumBlanks[c1] & (c1 != ord("*")) & (h2 >= 0))))
+    return star, np.where(valid, original, -1), expected
 
-    # Extract date and CPM measurements
+@trace(debugMode)
+def fixLogChecksums(filename, blockSize = logBlockSize):
+    # Repair the wrong checksums in place (memory mapped)
+    # return the number of repaired lines and of lines that can't be repaired in place
+    repaired = 0
+    failed = 0
+    bg = open(filename, "r+b")
     try:
-      bdate = s_time
-      dtime = datetime.strptime(bdate, '%Y-%m-%dT%H:%M:%SZ')
-
-      # Check time difference between readings
-      if dlasttime != 0 and timeSplit and not ignoreDelay:
-         delta = seconds_difference(dtime, dlasttime)
-         if delta > maxDelayBetweenReadings or delta < -maxDelayBetweenReadings:
-           split.close()
-           logCounter+=1
-           newFilename = "%s_%03d.LOG" % (logBaseName,logCounter)
-           newFiles.append(newFilename)
-           split = open(newFilename,"w")
-           blastlat = 0
-           blastlon = 0
-      dlasttime = dtime
-
-      # Convert from GPS format (DDDMM.MMMM..) to decimal degrees
-      blat = abs(float(s_latitude))/100
-      blon = abs(float(s_longitude))/100
-      blon = ((blon-int(blon))/60)*100+int(blon)
-      blat = ((blat-int(blat))/60)*100+int(blat)
-      if "S" == s_northsouthindicator: blat = -blat
-      if "W" == s_eastwestindicator: blon = -blon
-
-      if not worldMode:
-        # Outside Japan, skip the reading
-        if (blat < JP_lat_min) or (blat > JP_lat_max) or (blon < JP_lon_min) or (blon > JP_lon_max):
-            split.write("%s" % line)
-            continue
-      # Too far away, split the reading
-      if (blastlon != 0) and (blastlat != 0) and distanceSplit and not ignoreDistance:
-         deltakm = distance_on_unit_sphere(blastlat, blastlon, blat, blon)
-         if deltakm > maxDistanceBetweenReadings:
-           split.close()
-           logCounter+=1
-           newFilename = "%s_%03d.LOG" % (logBaseName,logCounter)
-           newFiles.append(newFilename)
-           split = open(newFilename,"w")
-           dlasttime = 0
-      blastlat = blat
-      blastlon = blon
-
-      split.write("%s" % line)
-    except:
-      # Something wrong, skip the reading
-      split.write("%s" % line)
-      continue
+      if not os.fstat(bg.fileno()).st_size:
+        return repaired, failed
+      mm = mmap.mmap(bg.fileno(), 0, access=mmap.ACCESS_WRITE)
+      data = np.frombuffer(mm, dtype=np.uint8)
+      try:
+        for starts, ends in lineBlocks(data, blockSize):
+          mat = bytesToMatrix(data, starts, ends)
+          star, original, expected = checksumMatrix(mat)
+          wrong = (mat[:, 0] != ord("#")) & (original >= 0) & (original != expected)
+
+          # Only 2 digits checksums can be replaced without moving the data
+          rows = np.flatnonzero(wrong)
+          digits = (hexTable[mat[rows, star[rows]+1]] >= 0) & (hexTable[mat[rows, np.minimum(star[rows]+2, mat.shape[1]-1)]] >= 0)
+          failed += (~digits).sum()
+          rows = rows[digits]
+          position = starts[rows] + star[rows] + 1
+          data[position] = hexDigits[expected[rows] >> 4]
+          data[position+1] = hexDigits[expected[rows] & 0xF]
+          repaired += len(rows)
+        mm.flush()
+      finally:
+        del data
+        mm.close()
+    finally:
+      bg.close()
+
+    print "%d checksums fixed in log %s (%d lines can't be fixed)" % (repaired, filename, failed)
+    return repaired, failed
+
+# Name of a drive of a log (same name for a single drive log)
+def driveFileName(filename, index, count):
+  if count <= 1:
+    return filename
+  return "%s_%03d.LOG" % (os.path.splitext(filename)[0], index+1)
 
-  split.close()
+# -----------------------------------------------------------------------------
+# Split bGeigie raw log file (the original log is left untouched)
+# -----------------------------------------------------------------------------
+@trace(debugMode)
+def splitLogFile(filename, timeSplit, distanceSplit, worldMode, ignoreDelay, ignoreDistance, fixChecksum = False):
+  # Find the drives in the log (memory mapped)
+  parser = LogParser(False, worldMode, ignoreDelay, ignoreDistance, False, timeSplit, distanceSplit)
+  offsets = [0]
+  for firstLine, starts, mat in mapLogBlocks(filename):
+    logCounter = len(parser.segments)
+    parser.scanMatrix(mat, firstLine)
+    offsets += [int(starts[s["line"]-firstLine]) for s in parser.segments[logCounter:]]
+  offsets.append(os.path.getsize(filename))
+
+  logCounter = len(parser.segments)
+  newFiles = []
+
+  # Write one file per drive
+  if logCounter > 1:
+    bg = open(filename, "rb")
+    for i in range(logCounter):
+      newFilename = driveFileName(filename, i, logCounter)
+      newFiles.append(newFilename)
+      split = open(newFilename, "wb")
+      copyFileRange(bg, split, offsets[i], offsets[i+1])
+      split.close()
+
+      # Check and fix the checksum values
+      if fixChecksum:
+        fixLogChecksums(newFilename)
+    bg.close()
 
   print "%d drives found in log %s" % (logCounter, filename)
   return newFiles
 
 # -----------------------------------------------------------------------------
-# Load bGeigie raw log file
+# Drive dataset (readings stored in a numpy structured array)
 # -----------------------------------------------------------------------------
-@trace(debugMode)
-def loadLogFile(filename, enableuSv, worldMode, ignoreDelay, ignoreDistance, tag, instantCPM):
-  # bGeigie Log format
-  # header + id + time + cpm + cp5s + totc + rnStatus + latitude + northsouthindicator + longitude + eastwestindicator + altitude + gpsStatus + dop + quality
-  global dbSupport
-
-  resultDriveId = []
-  resultDate = []
-  resultReading = []
-  resultLat = []
-  resultLon = []
-  resultAltitude = []
-  totalDose = 0
-
-  bgeigieModel = ""
-  bgeigieVersion = ""
-  bgeigieSerial = ""
-
-  # Load the bGeigie log file
-  bg = open(filename, "r")
-  lines = bg.readlines()
-  bg.close()
-
-  # Process the log
-  lineCounter = 0
-  dlasttime = 0
-  blastlon = 0
-  blastlat = 0
-  blastalt = 0
-
-  skippedLines = {"U": [], "H": [], "T": [], "D": [], "O": []}
-  # U Unknown
-  # H Header issue
-  # T Time issue
-  # D Distance issue
-  # O Out of Japan
-
-  # Connect to database
-  if dbSupport:
+readingType = np.dtype([("drive", np.int32),       # index in driveNames
+                        ("time", np.int64),        # epoch seconds (Zulu time)
+                        ("lat", np.float64),
+                        ("lon", np.float64),
+                        ("cpm", np.float64),       # CPM or uSv/h
+                        ("altitude", np.float64),
+                        ("instant", np.float64)])  # CPM or uSv/h from cp5s (5 seconds count)
+rowBlockSize = 4096
+
+class Drive:
+    # Readings of one or several drives + dose, skipped lines and bGeigie model
+    def __init__(self, readings, driveNames, dose = 0.0, skipped = None, model = ""):
+        self.readings = readings
+        self.driveNames = driveNames
+        self.dose = dose
+        if skipped is None:
+          skipped = {"U": [], "H": [], "T": [], "D": [], "O": []}
+        self.skipped = skipped
+        self.model = model
+
+    @staticmethod
+    def fromColumns(drive, time, lat, lon, cpm, altitude, dose = 0.0, skipped = None, model = "", instant = None):
+        # Drive ids are stored as categories
+        driveNames, driveIndex = np.unique(np.array(drive, dtype=str), return_inverse=True)
+        readings = np.empty(len(driveIndex), dtype=readingType)
+        readings["drive"] = driveIndex
+        readings["time"] = time
+        readings["lat"] = lat
+        readings["lon"] = lon
+        readings["cpm"] = cpm
+        readings["altitude"] = altitude
+        if instant is None:
+          # No 5 seconds count (database), the instant peak is the cpm peak
+          instant = cpm
+        readings["instant"] = instant
+        return Drive(readings, driveNames, dose, skipped, model)
+
+    def __len__(self):
+        return len(self.readings)
+
+    def __getitem__(self, key):
+        # Slice (view) or boolean mask/index array (copy) of the readings
+        return Drive(self.readings[key], self.driveNames, self.dose, self.skipped, self.model)
+
+    def __iter__(self):
+        return self.rows("drive", "time", "lat", "lon", "cpm", "altitude")
+
+    def rows(self, *columns):
+        # Iterate on some columns (field name or function of a block of readings)
+        for a in xrange(0, len(self), rowBlockSize):
+          block = self[a:a+rowBlockSize]
+          values = []
+          for c in columns:
+            if callable(c):
+              values.append(c(block))
+            else:
+              values.append(getattr(block, c))
+          for row in itertools.izip(*[v.tolist() for v in values]):
+            yield row
+
+    @property
+    def drive(self):
+        return self.driveNames[self.readings["drive"]]
+
+    @property
+    def time(self):
+        return self.readings["time"]
+
+    @property
+    def lat(self):
+        return self.readings["lat"]
+
+    @property
+    def lon(self):
+        return self.readings["lon"]
+
+    @property
+    def cpm(self):
+        return self.readings["cpm"]
+
+    @property
+    def altitude(self):
+        return self.readings["altitude"]
+
+    @property
+    def instant(self):
+        return self.readings["instant"]
+
+    def statistics(self):
+        cpm, altitude = self.cpm, self.altitude
+        return {"points": len(self),
+                "latMin": self.lat.min(), "latMax": self.lat.max(),
+                "lonMin": self.lon.min(), "lonMax": self.lon.max(),
+                "timeMin": self.time.min(), "timeMax": self.time.max(),
+                "cpmMin": cpm.min(), "cpmMax": cpm.max(), "cpmMean": cpm.mean(),
+                "altitudeMin": altitude.min(), "altitudeMax": altitude.max(), "altitudeMean": altitude.mean()}
+
+def concatenateDrives(drives, size = 0, dose = 0.0, skipped = None, model = ""):
+    # Readings of several drives in one Drive (size = expected number of readings)
+    readings = np.empty(size, dtype=readingType)
+    categories = {}
+    n = 0
+    for d in drives:
+      if n + len(d) > len(readings):
+        grown = np.empty(max(n + len(d), 2*len(readings)), dtype=readingType)
+        grown[:n] = readings[:n]
+        readings = grown
+      readings[n:n+len(d)] = d.readings
+
+      # Merge the drive id categories
+      driveIndex = np.array([categories.setdefault(name, len(categories)) for name in d.driveNames.tolist()], dtype=np.int32)
+      if len(driveIndex):
+        readings["drive"][n:n+len(d)] = driveIndex[d.readings["drive"]]
+      n += len(d)
+
+    driveNames = np.array(sorted(categories, key=categories.get), dtype=str)
+    return Drive(readings[:n], driveNames, dose, skipped, model)
+
+# -----------------------------------------------------------------------------
+# Parsed log cache (key = log content + parsing options)
+# -----------------------------------------------------------------------------
+skippedKeys = ["U", "H", "T", "D", "O"]
+
+def logContentKey(filename):
+    # Digest of the log content (same log under any name or path)
+    digest = hashlib.sha1()
+    f = open(filename, "rb")
     try:
-      connection = pymongo.Connection()
-      db = connection.databot
-      locations = db.locations
-    except:
-      dbSupport = False
-
-  for line in lines:
-    # Extract items (comma separated)
-    lineCounter += 1
-    if line[0] == "#":
-      if line.find("format=") != -1:
-         # Grab bgeigie version
-         bgeigieVersion = " %s" % (line[line.find("format=")+7:].strip())
-      continue # ignore comments
-    data = line.split(",")
-
-    # Check the checksum value
+      for block in iter(lambda: f.read(1 << 20), ""):
+        digest.update(block)
+    finally:
+      f.close()
+    return digest.hexdigest()
+
+def logCacheKey(contentKey, *parameters):
+    return hashlib.sha1(repr((logCacheVersion, contentKey)+parameters)).hexdigest()
+
+def logCacheEntries():
+    # (last use, size, path) sorted from the least recently used
+    entries = []
+    for path in glob.glob(os.path.join(logCacheFolder, "*.npz")):
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue # removed by another process
+      entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    return entries
+
+def removeCacheFile(path):
     try:
-      original = int(line.split("*")[1][:2],16)
-      expected = get_checksum(line.split("*")[0])
-      if original != expected:
-        print "WARNING: line %d wrong checksum 0x%02X, expected 0x%02X" % (lineCounter, original, expected)
-    except:
-      skippedLines["H"].append(lineCounter)
-      continue
-
-    # Crop any extra columns
-    data = data[:maxDataColumns]
-
-    # Check for bGeigieMini or bGeigie
-    if data[0] == "$BMRDD" or data[0] == "$BGRDD" or data[0] == "$BNRDD":
-      if bgeigieModel == "":
-         if data[0] == "$BMRDD": bgeigieModel = "bGeigieMini"
-         elif data[0] == "$BGRDD": bgeigieModel = "bGeigieClassic"
-         elif data[0] == "$BNRDD": bgeigieModel = "bGeigieNano"
-      if len(data) != maxDataColumns or data[6] != "A" or data[12] != "A":
-         skippedLines["H"].append(lineCounter)
-         continue
-
-      # Unpack the data
-      (s_header,s_id,s_time,
-       s_cpm,s_cp5s,s_totc,
-       s_rnStatus,s_latitude,s_northsouthindicator,s_longitude,s_eastwestindicator,
-       s_altitude,s_gpsStatus,s_dop,s_quality) = data
-    else:
-      # Ignore invalid data
-      skippedLines["H"].append(lineCounter)
-      continue
+      os.remove(path)
+    except OSError:
+      pass
 
-    # Extract serial number
-    if (bgeigieSerial == ""):
-      bgeigieSerial = "(#%s)" % s_id
+def loadLogCache(key):
+    path = os.path.join(logCacheFolder, key+".npz")
+    if not os.path.exists(path):
+      return None
 
-    # Extract date and CPM measurements
     try:
-      bdate = s_time
-      dtime = datetime.strptime(bdate, '%Y-%m-%dT%H:%M:%SZ')
-
-      # Check time difference between readings
-      if dlasttime != 0 and not ignoreDelay:
-         delta = seconds_difference(dtime, dlasttime)
-         if delta > maxDelayBetweenReadings or delta < -maxDelayBetweenReadings:
-           print "WARNING: line %d unexpected delay between measures [%d]" % (lineCounter, delta)
-           skippedLines["T"].append(lineCounter)
-           continue
-      dlasttime = dtime
+      cache = np.load(path)
+      try:
+        readings, driveNames, bounds = cache["readings"], cache["driveNames"], cache["bounds"]
+        doses, skippedCounts, skippedLines = cache["doses"], cache["skippedCounts"], cache["skippedLines"]
+        model = str(cache["model"])
+      finally:
+        cache.close()
+      os.utime(path, None) # most recently used
+    except:
+      print "[CACHE] Invalid entry %s removed" % path
+      removeCacheFile(path)
+      return None
+
+    drives = []
+    positions = np.concatenate(([0], np.cumsum(skippedCounts.ravel())))
+    for i in range(len(doses)):
+      skipped = {}
+      for j, k in enumerate(skippedKeys):
+        n = i*len(skippedKeys)+j
+        skipped[k] = skippedLines[positions[n]:positions[n+1]].tolist()
+      drives.append(Drive(readings[bounds[i]:bounds[i+1]], driveNames, float(doses[i]), skipped, model))
+    return drives
+
+def saveLogCache(key, drives):
+    try:
+      os.makedirs(logCacheFolder)
+    except OSError:
+      pass # already created
 
-      if instantCPM:
-        bcpm = float(s_cp5s)*12
-      else:
-        bcpm = float(s_cpm)
-      if enableuSv: bcpm /= CPMfactor
-      totalDose += float(s_cp5s)
-      baltitude = float(s_altitude)
-
-      # Convert from GPS format (DDDMM.MMMM..) to decimal degrees
-      blat = abs(float(s_latitude))/100
-      blon = abs(float(s_longitude))/100
-      blon = ((blon-int(blon))/60)*100+int(blon)
-      blat = ((blat-int(blat))/60)*100+int(blat)
-      if "S" == s_northsouthindicator: blat = -blat
-      if "W" == s_eastwestindicator: blon = -blon
-
-      # Invalid, skip the reading
-      if (((blat == 0) and (blon == 0)) or
-          ((blat < -90.0) or (blat > 90.0) or (blon < -180) or (blon > 180))):
-        skippedLines["U"].append(lineCounter)
-        continue
+    skipped = [np.array(d.skipped[k], dtype=np.int64) for d in drives for k in skippedKeys]
+    temp = tempfile.NamedTemporaryFile(dir=logCacheFolder, suffix=".tmp", delete=False)
+    try:
+      np.savez(temp,
+        readings = np.concatenate([d.readings for d in drives]),
+        driveNames = drives[0].driveNames,
+        bounds = np.cumsum([0]+[len(d) for d in drives]),
+        doses = np.array([d.dose for d in drives], dtype=np.float64),
+        skippedCounts = np.array([len(s) for s in skipped]).reshape(len(drives), len(skippedKeys)),
+        skippedLines = np.concatenate(skipped),
+        model = np.array(drives[0].model))
+      temp.close()
+      os.rename(temp.name, os.path.join(logCacheFolder, key+".npz"))
+    except (IOError, OSError):
+      print "[CACHE] Can't write %s" % key
+      temp.close()
+      removeCacheFile(temp.name)
+      return
+
+    # Least recently used eviction
+    entries = logCacheEntries()
+    total = sum([size for last, size, path in entries])
+    for last, size, path in entries:
+      if total <= logCacheMaxSize:
+        break
+      removeCacheFile(path)
+      total -= size
+
+def configureLogCache(options):
+    global logCacheEnabled, logCacheFolder, logCacheMaxSize
+    logCacheEnabled = getattr(options, "cache", logCacheEnabled)
+    logCacheFolder = getattr(options, "cacheFolder", None) or logCacheFolder
+    if getattr(options, "cacheSize", None) is not None:
+      logCacheMaxSize = int(options.cacheSize*1024*1024)
+
+def listLogCache():
+    entries = logCacheEntries()
+    print "Log cache %s" % logCacheFolder
+    for last, size, path in reversed(entries):
+      print "%s\t%10d\t%s" % (datetime.fromtimestamp(last).strftime("%Y-%m-%d %H:%M:%S"), size, os.path.basename(path))
+    print "%d entries, %.1f/%.1f MB" % (len(entries), sum([e[1] for e in entries])/1048576.0, logCacheMaxSize/1048576.0)
+
+def purgeLogCache():
+    entries = logCacheEntries()
+    for last, size, path in entries:
+      removeCacheFile(path)
+    print "%d entries removed from %s" % (len(entries), logCacheFolder)
 
-      if not worldMode:
-      # Outside Japan, skip the reading
-        if (blat < JP_lat_min) or (blat > JP_lat_max) or (blon < JP_lon_min) or (blon > JP_lon_max):
-           skippedLines["O"].append(lineCounter)
-           continue
+# -----------------------------------------------------------------------------
+# Buffered database writer (bulk inserts)
+# -----------------------------------------------------------------------------
+def logDates(drive):
+    # YYYY-MM-DDTHH:MM:SSZ of the readings
+    return np.char.add(formatEpoch(drive.time), "Z")
+
+def dbDateToEpoch(date):
+    return calendar.timegm(datetime.strptime(date, '%Y-%m-%dT%H:%M:%SZ').timetuple())
+
+class ReadingWriter:
+    # Any collection with insert(list of documents) can be used (tests)
+    def __init__(self, collection, connection = None, batchSize = None):
+        self.collection = collection
+        self.connection = connection
+        self.batchSize = batchSize or dbBatchSize
+        self.pid = os.getpid()
+        self.buffer = []
+        self.count = 0
+
+    def write(self, drive, tag, log):
+        # Same documents as before the columnar parser (date as in the log)
+        for (s_id, bdate, blat, blon, bcpm, baltitude) in drive.rows("drive", logDates, "lat", "lon", "cpm", "altitude"):
+          self.buffer.append(
+            {'loc': [blat, blon],
+            'altitude': baltitude,
+            'tag': tag,
+            'log': log,
+            'drive' : s_id,
+            'date' : bdate,
+            'cpm': bcpm})
+          if len(self.buffer) >= self.batchSize:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+          self.collection.insert(self.buffer)
+          self.count += len(self.buffer)
+          self.buffer = []
+
+    def createIndexes(self):
+        self.collection.create_index([('loc', pymongo.GEO2D)])
+        self.collection.create_index([('loc', pymongo.GEOHAYSTACK), ("type", pymongo.ASCENDING)], bucket_size=1)
+
+    def close(self):
+        self.flush()
+        if self.connection is not None:
+          self.connection.disconnect()
+
+dbWriter = None # shared by all the logs of the process
+
+def getDbWriter():
+    # One client per process (a client can't be used after a fork)
+    global dbWriter, dbSupport
+    if dbWriter is not None and dbWriter.pid == os.getpid():
+      return dbWriter
+    dbWriter = None
+    if dbSupport:
+      try:
+        connection = pymongo.Connection()
+        dbWriter = ReadingWriter(connection.databot.locations, connection)
+      except:
+        dbSupport = False
+    return dbWriter
+
+def closeDbWriter(createIndexes = True):
+    # Flush, build the indexes once for all the logs and disconnect
+    global dbWriter
+    if dbWriter is not None and dbWriter.pid == os.getpid():
+      dbWriter.flush()
+      if createIndexes:
+        dbWriter.createIndexes()
+      dbWriter.close()
+    dbWriter = None
+    closeSummaryStore()
 
-      # Too far away, skip the reading
-      if (blastlon != 0) and (blastlat != 0) and not ignoreDistance:
-        deltakm = distance_on_unit_sphere(blastlat, blastlon, blat, blon)
-        if deltakm > maxDistanceBetweenReadings:
-           skippedLines["D"].append(lineCounter)
-           continue
+# -----------------------------------------------------------------------------
+# Parse bGeigie raw log file, one result per drive
+# -----------------------------------------------------------------------------
+def parseLogDrives(filename, enableuSv, worldMode, ignoreDelay, ignoreDistance, instantCPM, timeSplit, distanceSplit):
+  # Process the memory mapped log by blocks (columnar mode), drives are split on the fly
+  parser = LogParser(enableuSv, worldMode, ignoreDelay, ignoreDistance, instantCPM, timeSplit, distanceSplit)
+  # At most one block preallocated, the buffer doubles with the readings kept
+  buffer = ReadingBuffer(min(os.path.getsize(filename)/logLineSize, logBlockSize))
+  for firstLine, starts, mat in mapLogBlocks(filename):
+    buffer.append(parser.parseMatrix(mat, np.arange(firstLine, firstLine+len(mat))))
+  if not buffer.size:
+    buffer.append(parser.parseLines([]))
+  readings = buffer.compact()
 
-      blastlat = blat
-      blastlon = blon
+  # Get the bgeigie model
+  model = parser.model()
+
+  # Instant CPM (same computation as instantCPM mode)
+  instant = readings["cp5s"]*12
+  if enableuSv: instant /= CPMfactor
+
+  bounds = np.searchsorted(readings["segment"], np.arange(len(parser.segments)+1))
+  drives = Drive.fromColumns(readings["drive"], readings["time"], readings["lat"], readings["lon"], readings["cpm"], readings["altitude"], model = model, instant = instant)
+  del readings
+  segments = []
+  for i, segment in enumerate(parser.segments):
+    drive = Drive(drives.readings[bounds[i]:bounds[i+1]], drives.driveNames, segment["dose"], segment["skipped"], model)
+    if enableuSv: drive.dose /= CPMfactor
+    segments.append(drive)
+  return segments
 
-    except:
-      print '-'*60
-      print "Error in line %d" % lineCounter
-      print line
-      traceback.print_exc(file=sys.stdout)
-      print '-'*60
-      # Something wrong, skip the reading
-      skippedLines["U"].append(lineCounter)
-      continue
+# -----------------------------------------------------------------------------
+# Load bGeigie raw log file, one result per drive
+# -----------------------------------------------------------------------------
+def parsedLogDrives(filename, contentKey, parameters):
+  # Drives of a log from the parsed log cache, or parsed and cached
+  drives = None
+  if logCacheEnabled:
+    cacheKey = logCacheKey(contentKey, *parameters)
+    drives = loadLogCache(cacheKey)
+    if drives is not None:
+      print "[CACHE] %s loaded from cache" % filename
+  if drives is None:
+    drives = parseLogDrives(filename, *parameters)
+    if logCacheEnabled:
+      saveLogCache(cacheKey, drives)
+  return drives
 
-    # Check if altitude is valid, clip if necessary
-    if (baltitude < 0):
-      baltitude = 0
-    elif (baltitude > JP_alt_max) and not worldMode:
-      baltitude = JP_alt_max
+@trace(debugMode)
+def loadLogSegments(filename, enableuSv, worldMode, ignoreDelay, ignoreDistance, tag, instantCPM, timeSplit = True, distanceSplit = False):
+  # bGeigie Log format
+  # header + id + time + cpm + cp5s + totc + rnStatus + latitude + northsouthindicator + longitude + eastwestindicator + altitude + gpsStatus + dop + quality
+  # Parse the log (or reuse the result of a previous run)
+  parameters = (enableuSv, worldMode, ignoreDelay, ignoreDistance, instantCPM, timeSplit, distanceSplit)
+  contentKey = None
+  if logCacheEnabled or summaryStoreEnabled:
+    contentKey = logContentKey(filename)
+  drives = parsedLogDrives(filename, contentKey, parameters)
+
+  # Shared database writer
+  writer = getDbWriter()
+
+  # The summary store is always fed with the same parsing options
+  store = getSummaryStore()
+  if store is not None and not store.counted(contentKey):
+    storeDrives = drives
+    if parameters != summaryParameters:
+      storeDrives = parsedLogDrives(filename, contentKey, summaryParameters)
+    store.update(contentKey, os.path.basename(filename),
+                 concatenateDrives(storeDrives, sum([len(d) for d in storeDrives]), sum([d.dose for d in storeDrives])))
+
+  # Drive names are the files written by splitLogFile
+  segments = []
+  for i, drive in enumerate(drives):
+    name = driveFileName(filename, i, len(drives))
 
     # Insert result to database
-    if dbSupport:
-      locations.insert(
-        {'loc': [blat, blon],
-        'altitude': baltitude,
-        'tag': tag,
-        'log': os.path.basename(filename),
-        'drive' : s_id,
-        'date' : bdate,
-        'cpm': bcpm})
-
-    # Store the results
-    resultDriveId.append(s_id)
-    resultDate.append(bdate)
-    resultReading.append(bcpm)
-    resultLat.append(blat)
-    resultLon.append(blon)
-    resultAltitude.append(baltitude)
-
-  resultLat = np.array(resultLat)
-  resultLon = np.array(resultLon)
-  resultReading = np.array(resultReading)
-  resultAltitude = np.array(resultAltitude)
-  if enableuSv: totalDose /= CPMfactor
+    if writer is not None:
+      writer.write(drive, tag, os.path.basename(name))
 
-  # Get the bgeigie model
-  if (bgeigieModel != ""):
-    model = "%s%s %s" % (bgeigieModel, bgeigieVersion, bgeigieSerial)
-  else:
-    model = ""
+    print "[LOG] Lines skipped =",drive.skipped
+    segments.append((name, drive))
 
-  print "[LOG] Lines skipped =",skippedLines
+  # Send the rest of the readings (the indexes are built by closeDbWriter)
+  if writer is not None:
+    writer.flush()
 
-  # Close database connection
-  if dbSupport:
-    locations.create_index([('loc', pymongo.GEO2D)])
-    locations.create_index([('loc', pymongo.GEOHAYSTACK), ("type", pymongo.ASCENDING)], bucket_size=1)
-    connection.disconnect()
-
-  return (resultDriveId, resultDate, resultLat, resultLon, resultReading, resultAltitude, totalDose, skippedLines, model)
+  if len(segments) > 1:
+    print "%d drives found in log %s" % (len(segments), filename)
+  return segments
 
 # -----------------------------------------------------------------------------
-# Load bGeigie database data
+# Load bGeigie raw log file
 # -----------------------------------------------------------------------------
 @trace(debugMode)
-def loadDbData(model, enableuSv, logs):
-  # bGeigie Log format
-  # header + id + time + cpm + cp5s + totc + rnStatus + latitude + northsouthindicator + longitude + eastwestindicator + altitude + gpsStatus + dop + quality
+def loadLogFile(filename, enableuSv, worldMode, ignoreDelay, ignoreDistance, tag, instantCPM):
+  name, data = loadLogSegments(filename, enableuSv, worldMode, ignoreDelay, ignoreDistance, tag, instantCPM, False, False)[0]
+  return data
 
-  print "Generating summary report from", logs
-
-  resultDriveId = []
-  resultDate = []
-  resultReading = []
-  resultLat = []
-  resultLon = []
-  resultAltitude = []
-  totalDose = 0
-  skippedLines = {"U": [], "H": [], "T": [], "D": [], "O": []}
-
-  # db connection
-  connection = pymongo.Connection()
-  db = connection.databot
-  locations = db.locations
-  cursors = locations.find({'$or' : logs})
-
-  for data in cursors:
-    # Store the results
-    resultDriveId.append(data['drive'])
-    resultDate.append(data['date'])
-    resultReading.append(data['cpm'])
-    resultLat.append(data['loc'][0])
-    resultLon.append(data['loc'][1])
-    resultAltitude.append(data['altitude'])
-
-  resultLat = np.array(resultLat)
-  resultLon = np.array(resultLon)
-  resultReading = np.array(resultReading)
-  resultAltitude = np.array(resultAltitude)
-  if enableuSv: totalDose /= CPMfactor
-
-  return (resultDriveId, resultDate, resultLat, resultLon, resultReading, resultAltitude, totalDose, skippedLines, model)
+# -----------------------------------------------------------------------------
+# bGeigie database data aggregated by MongoDB (summary of large areas)
+# -----------------------------------------------------------------------------
+def dbLogQuery(logs):
+  return {'log': {'$in': [l['log'] for l in logs]}}
+
+# np.digitize (number of edges <= value) as a database expression, constant
+# time per document: the edges range is cut in slots of the smallest bin
+# (at most one edge inside a slot), the index at the start of the slot is
+# looked up and corrected by the edges around the slot start. The grid edges
+# are nearly regular so the lookup tables stay as small as the grid.
+# $floor and $arrayElemAt need MongoDB 3.2
+def dbDigitize(value, edges):
+    edges = np.asarray(edges, dtype=np.float64)
+    step = float(np.diff(edges).min()) if len(edges) > 1 else 1.0
+    slots = int(math.ceil((edges[-1]-edges[0])/step))+1
+    index = np.digitize(edges[0]+np.arange(slots)*step, edges)
+    below = edges[index-1]
+    above = np.append(edges, np.inf)[index]
+    slot = {'$floor': {'$divide': [{'$subtract': ['$$value', float(edges[0])]}, step]}}
+    inside = {'$add': [{'$arrayElemAt': [index.tolist(), '$$slot']},
+                       {'$cond': [{'$gte': ['$$value', {'$arrayElemAt': [above.tolist(), '$$slot']}]}, 1, 0]},
+                       {'$cond': [{'$lt': ['$$value', {'$arrayElemAt': [below.tolist(), '$$slot']}]}, -1, 0]}]}
+    return {'$let': {'vars': {'value': value},
+      'in': {'$let': {'vars': {'slot': slot},
+        'in': {'$cond': [{'$lt': ['$$slot', 0]}, 0,
+               {'$cond': [{'$gte': ['$$slot', slots]}, len(edges), inside]}]}}}}}
+
+dbAggregationVersion = (3, 2) # oldest server supporting the DbReadings aggregations
+
+def dbAggregationSupport(connection):
+    try:
+      version = tuple([int(v) for v in connection.server_info()["version"].split(".")[:2]])
+    except:
+      return False
+    return version >= dbAggregationVersion
+
+def aggregateResult(result):
+  # pymongo < 3 returns {"result": [...]}, pymongo >= 3 a cursor
+  if isinstance(result, dict):
+    return result["result"]
+  return list(result)
+
+class DbReadings:
+    # Same statistics() as Drive but the binning is computed by the database,
+    # only one document per occupied cell is transferred
+    def __init__(self, logs, locations = None, dose = 0.0, skipped = None, model = ""):
+        self.logs = logs
+        self.locations = locations
+        self.connection = None
+        self.pid = None
+        self.dose = dose
+        if skipped is None:
+          skipped = {"U": [], "H": [], "T": [], "D": [], "O": []}
+        self.skipped = skipped
+        self.model = model
+        self.stats = None
+
+    def collection(self):
+        # One client per process (drawMap may run in a forked process)
+        if self.locations is not None:
+          return self.locations
+        if self.pid != os.getpid():
+          self.connection = pymongo.Connection()
+          self.pid = os.getpid()
+        return self.connection.databot.locations
+
+    def close(self):
+        if self.connection is not None and self.pid == os.getpid():
+          self.connection.disconnect()
+        self.connection = None
+
+    def __len__(self):
+        return self.statistics()["points"]
+
+    def statistics(self):
+        if self.stats is None:
+          lat, lon = {'$arrayElemAt': ['$loc', 0]}, {'$arrayElemAt': ['$loc', 1]}
+          result = aggregateResult(self.collection().aggregate([
+            {'$match': dbLogQuery(self.logs)},
+            {'$group': {'_id': None,
+              'points': {'$sum': 1},
+              'latMin': {'$min': lat}, 'latMax': {'$max': lat},
+              'lonMin': {'$min': lon}, 'lonMax': {'$max': lon},
+              'timeMin': {'$min': '$date'}, 'timeMax': {'$max': '$date'},
+              'cpmMin': {'$min': '$cpm'}, 'cpmMax': {'$max': '$cpm'}, 'cpmMean': {'$avg': '$cpm'},
+              'altitudeMin': {'$min': '$altitude'}, 'altitudeMax': {'$max': '$altitude'}, 'altitudeMean': {'$avg': '$altitude'}}}]))
+          if result:
+            self.stats = result[0]
+            del self.stats["_id"]
+            self.stats["timeMin"] = dbDateToEpoch(self.stats["timeMin"])
+            self.stats["timeMax"] = dbDateToEpoch(self.stats["timeMax"])
+          else:
+            self.stats = {"points": 0}
+        return self.stats
+
+    def cells(self, lonEdges, latEdges):
+        result = aggregateResult(self.collection().aggregate([
+          {'$match': dbLogQuery(self.logs)},
+          {'$project': {'cpm': True,
+            'x': dbDigitize({'$arrayElemAt': ['$loc', 1]}, lonEdges),
+            'y': dbDigitize({'$arrayElemAt': ['$loc', 0]}, latEdges)}},
+          {'$group': {'_id': {'x': '$x', 'y': '$y'},
+            'count': {'$sum': 1}, 'sum': {'$sum': '$cpm'}, 'max': {'$max': '$cpm'}, 'min': {'$min': '$cpm'}}}]))
+        return (np.array([c['_id']['x'] for c in result], dtype=np.int64),
+                np.array([c['_id']['y'] for c in result], dtype=np.int64),
+                np.array([c['count'] for c in result], dtype=np.int64),
+                np.array([c['sum'] for c in result], dtype=np.float64),
+                np.array([c['max'] for c in result], dtype=np.float64),
+                np.array([c['min'] for c in result], dtype=np.float64))
+
+    def binning(self, m, x_min, y_min, x_max, y_max, xbins, ybins):
+        # Projected bin edges back to longitude/latitude (Mercator: monotonic)
+        binsLon, binsLat = rectangularBinEdges(x_min, y_min, x_max, y_max, xbins, ybins)
+        lonEdges, ignore = m(binsLon, np.repeat(y_min, len(binsLon)), inverse=True)
+        ignore, latEdges = m(np.repeat(x_min, len(binsLat)), binsLat, inverse=True)
+        cells = self.cells(np.asarray(lonEdges, dtype=float).tolist(), np.asarray(latEdges, dtype=float).tolist())
+        return rectangularBinCells(x_min, y_min, x_max, y_max, cells, xbins, ybins)
+
+# -----------------------------------------------------------------------------
+# Persistent summary (per cell aggregates updated by each log, kept between runs)
+# -----------------------------------------------------------------------------
+def summaryCells(drive):
+    # (y, x, count, sum, max) per occupied cell of the fixed summaryCellSize grid
+    lat, lon, cpm = drive.lat, drive.lon, drive.cpm
+    valid = np.isfinite(lat) & np.isfinite(lon) & np.isfinite(cpm)
+    y = np.floor(lat[valid]/summaryCellSize).astype(np.int64)
+    x = np.floor(lon[valid]/summaryCellSize).astype(np.int64)
+    cpm = cpm[valid]
+    if not len(cpm):
+      return y, x, np.zeros(0, dtype=np.int64), cpm, cpm
+    order = np.lexsort((x, y))
+    y, x, cpm = y[order], x[order], cpm[order]
+    starts = np.flatnonzero(np.concatenate(([True], (y[1:] != y[:-1]) | (x[1:] != x[:-1]))))
+    count = np.diff(np.append(starts, len(cpm)))
+    return y[starts], x[starts], count, np.add.reduceat(cpm, starts), np.maximum.reduceat(cpm, starts)
+
+def combineStatistics(statistics):
+    # Statistics of several drives from the statistics of each one
+    statistics = [s for s in statistics if s["points"]]
+    if not statistics:
+      return {"points": 0}
+    points = sum([s["points"] for s in statistics])
+    result = {"points": points}
+    for key in ["lat", "lon", "time", "cpm", "altitude"]:
+      result[key+"Min"] = min([s[key+"Min"] for s in statistics])
+      result[key+"Max"] = max([s[key+"Max"] for s in statistics])
+    for key in ["cpm", "altitude"]:
+      result[key+"Mean"] = sum([s[key+"Mean"]*s["points"] for s in statistics])/float(points)
+    return result
+
+class SummaryStore:
+    # databot.cells:       one document per cell {_id, y, x, count, sum, max, updated}
+    # databot.cellLogs:    contribution of each log to each cell {log, cell, y, x, count, sum, max}
+    # databot.summaryLogs: one document per log {_id: content key, name, complete, statistics, dose, updated}
+    # The logs are identified by their content (logContentKey): a log already
+    # counted is skipped whatever its name, two logs with the same name are
+    # both counted, so reprocessing never double-counts.
+    def __init__(self, db, dose = 0.0, skipped = None, model = ""):
+        self.cells = db.cells
+        self.cellLogs = db.cellLogs
+        self.logs = db.summaryLogs
+        self.cellLogs.create_index([("log", pymongo.ASCENDING)])
+        self.cellLogs.create_index([("cell", pymongo.ASCENDING)])
+        self.pid = os.getpid()
+        self.dose = dose
+        if skipped is None:
+          skipped = {"U": [], "H": [], "T": [], "D": [], "O": []}
+        self.skipped = skipped
+        self.model = model
+
+    def counted(self, key):
+        previous = self.logs.find_one({"_id": key})
+        return previous is not None and previous.get("complete", False)
+
+    def update(self, key, name, drive):
+        previous = self.logs.find_one({"_id": key})
+        if previous is not None:
+          if previous.get("complete"):
+            print "[SUMMARY] %s already counted" % name
+            return False
+          self.remove(key)
+
+        # Contributions first: an interrupted update is rebuilt from them by remove()
+        statistics = {"points": 0}
+        if len(drive):
+          statistics = dict([(k, float(v)) for k, v in drive.statistics().items()])
+          statistics["points"] = len(drive)
+        self.logs.save({"_id": key, "name": name, "complete": False,
+                        "statistics": statistics, "dose": float(drive.dose), "updated": datetime.utcnow()})
+        contributions = []
+        for y, x, count, total, maximum in zip(*[c.tolist() for c in summaryCells(drive)]):
+          contributions.append({"log": key, "cell": "%d:%d" % (y, x), "y": y, "x": x, "count": count, "sum": total, "max": maximum})
+        if contributions:
+          self.cellLogs.insert(contributions)
+          now = datetime.utcnow()
+          bulk = self.cells.initialize_unordered_bulk_op()
+          for c in contributions:
+            bulk.find({"_id": c["cell"]}).upsert().update(
+              {"$inc": {"count": c["count"], "sum": c["sum"]}, "$max": {"max": c["max"]},
+               "$set": {"y": c["y"], "x": c["x"], "updated": now}})
+          bulk.execute()
+        self.logs.update({"_id": key}, {"$set": {"complete": True}})
+        print "[SUMMARY] %s: %d cells updated" % (name, len(contributions))
+        return True
+
+    def remove(self, key):
+        # Remove the contribution of the log. The counts and sums of a counted
+        # log are decremented in place ($inc, atomic with the updates of the
+        # other processes), the cells of an interrupted one are rebuilt from the
+        # other contributions.
+        previous = self.logs.find_one({"_id": key})
+        contributions = list(self.cellLogs.find({"log": key}))
+        ids = [c["cell"] for c in contributions]
+        now = datetime.utcnow()
+        if previous is not None and previous.get("complete") and contributions:
+          # Rebuilt from the contributions if interrupted from now on
+          self.logs.update({"_id": key}, {"$set": {"complete": False}})
+          bulk = self.cells.initialize_unordered_bulk_op()
+          for c in contributions:
+            bulk.find({"_id": c["cell"]}).update({"$inc": {"count": -c["count"], "sum": -c["sum"]}, "$set": {"updated": now}})
+          bulk.execute()
+          self.cellLogs.remove({"log": key})
+          self.cells.remove({"_id": {"$in": ids}, "count": {"$lte": 0}})
+          # The maximum can't be decremented: recomputed from the other
+          # contributions, then raised again by the ones added meanwhile
+          self.updateMaximums(ids, "$set")
+          self.updateMaximums(ids, "$max")
+        elif contributions:
+          self.cellLogs.remove({"log": key})
+          cells = {}
+          for c in self.cellLogs.find({"cell": {"$in": ids}}):
+            count, total, maximum = cells.get(c["cell"], (0, 0.0, None))
+            cells[c["cell"]] = (count+c["count"], total+c["sum"], max(maximum, c["max"]))
+          for cell in ids:
+            if cell in cells:
+              count, total, maximum = cells[cell]
+              self.cells.update({"_id": cell}, {"$set": {"count": count, "sum": total, "max": maximum, "updated": now}})
+            else:
+              self.cells.remove({"_id": cell})
+        self.logs.remove({"_id": key})
+
+    def updateMaximums(self, ids, operator):
+        maximums = {}
+        for c in self.cellLogs.find({"cell": {"$in": ids}}, {"cell": True, "max": True}):
+          maximums[c["cell"]] = max(maximums.get(c["cell"], c["max"]), c["max"])
+        if not maximums:
+          return
+        bulk = self.cells.initialize_unordered_bulk_op()
+        for cell, maximum in maximums.items():
+          bulk.find({"_id": cell}).update({operator: {"max": maximum}})
+        bulk.execute()
+
+    def __len__(self):
+        return self.statistics()["points"]
+
+    def statistics(self):
+        return combineStatistics([l["statistics"] for l in self.logs.find({"complete": True}, {"statistics": True})])
+
+    def binning(self, m, x_min, y_min, x_max, y_max, xbins, ybins):
+        # Cell centers projected and binned like the readings, the cells are
+        # only read from the database (constant time in the number of readings)
+        fields = {"_id": False, "y": True, "x": True, "count": True, "sum": True, "max": True}
+        cells = list(self.cells.find({}, fields).batch_size(dbCursorBatchSize))
+        lat = (np.array([c["y"] for c in cells], dtype=np.float64)+0.5)*summaryCellSize
+        lon = (np.array([c["x"] for c in cells], dtype=np.float64)+0.5)*summaryCellSize
+        x, y = m(lon, lat)
+        binsLon, binsLat = rectangularBinEdges(x_min, y_min, x_max, y_max, xbins, ybins)
+        return rectangularBinCells(x_min, y_min, x_max, y_max,
+          (np.digitize(x, binsLon), np.digitize(y, binsLat),
+           np.array([c["count"] for c in cells], dtype=np.int64),
+           np.array([c["sum"] for c in cells], dtype=np.float64),
+           np.array([c["max"] for c in cells], dtype=np.float64)), xbins, ybins)
+
+summaryStore = None # shared by all the logs of the process
+
+def getSummaryStore():
+    # Uses the client of the database writer (one per process)
+    global summaryStore
+    if summaryStore is not None and summaryStore.pid == os.getpid():
+      return summaryStore
+    summaryStore = None
+    writer = getDbWriter()
+    if summaryStoreEnabled and writer is not None and writer.connection is not None:
+      try:
+        summaryStore = SummaryStore(writer.connection.databot)
+      except:
+        logPrint('-'*60)
+        traceback.print_exc(file=sys.stdout)
+        logPrint('-'*60)
+    return summaryStore
+
+def closeSummaryStore():
+    global summaryStore
+    summaryStore = None
 
 # -----------------------------------------------------------------------------
 # Compute a rectangular binning from input data (x,y,value)
@@ -666,11 +1705,7 @@ def loadDbData(model, enableuSv, logs):
 # Based on threads
 # from http://stackoverflow.com/questions/2275924/how-to-get-data-in-a-histogram-bin
 #      http://stackoverflow.com/questions/8805601/efficiently-create-2d-histograms-from-large-datasets
-@trace(debugMode)
-def rectangularBinNumpy(x_min,y_min,x_max,y_max, data, xbins,ybins=None,peak=False):
-    if (ybins == None): ybins = xbins
-    xdata, ydata, cpm = zip(*data)
-
+def rectangularBinEdges(x_min,y_min,x_max,y_max, xbins,ybins):
     # Get min, max and width of dataset
     xwidth = max(1, x_max-x_min)
     ywidth = max(1, y_max-y_min)
@@ -679,47 +1714,99 @@ def rectangularBinNumpy(x_min,y_min,x_max,y_max, data, xbins,ybins=None,peak=Fal
 
     # Bins
     binsLon = np.array([int(x_min+x*xSize) for x in range( int(xwidth/xSize)+1)])
-    dLon = np.digitize(xdata, binsLon)
     binsLat = np.array([int(y_min+y*ySize) for y in range( int(ywidth/ySize)+1)])
-    dLat = np.digitize(ydata, binsLat)
+    return binsLon, binsLat
+
+# Cell index (row major, first row at the top) of the digitized positions,
+# -1 outside of the grid (negative indexes wrap around like list indexes)
+def rectangularBinIndex(dLon, dLat, xbins, ybins):
+    xb = np.asarray(dLon, dtype=np.int64) - 1
+    yb = ybins - np.asarray(dLat, dtype=np.int64)
+    inside = (xb >= -xbins) & (xb < xbins) & (yb >= -ybins) & (yb < ybins)
+    return np.where(inside, (yb % ybins)*xbins + xb % xbins, -1)
+
+# Statistics of the occupied cells only (memory bounded by the number of
+# readings, not by the area) computed in one pass: sorted cell indexes,
+# {"count", "mean", "max", "min", "peak5"} arrays, extent and label centers.
+# minimum and instant are optional (not available in the database aggregates).
+def rectangularBinReduce(x_min,y_min,x_max,y_max, index, count, total, maximum, minimum, instant, xbins, ybins):
+    xwidth = max(1, x_max-x_min)
+    ywidth = max(1, y_max-y_min)
+    xSize = float(xwidth/xbins)
+    ySize = float(ywidth/ybins)
 
-    def centerbin(x,y):
-      # Compute bin center position for labels
-      cx = int(x*xSize+xSize/2)
-      cy = int(y*ySize+ySize/2)
-      return (cx,cy)
+    inside = index >= 0
+    cells, inverse = np.unique(index[inside], return_inverse=True)
+    def extremum(function, initial, values):
+      # fmax/fmin ignore NaN like the "if c > avg" test of the peak mode
+      result = np.empty(len(cells))
+      result.fill(initial)
+      function.at(result, inverse, values[inside])
+      return result
+
+    # bincount adds the values in the readings order (same rounding as a loop)
+    if count is None:
+      counts = np.bincount(inverse, minlength=len(cells))
+    else:
+      counts = np.bincount(inverse, weights=count[inside], minlength=len(cells))
+    totals = np.bincount(inverse, weights=total[inside], minlength=len(cells))
+    stats = {"count": counts,
+             "mean": totals/np.maximum(counts, 1),
+             "max": extremum(np.fmax, -np.inf, maximum)}
+    if minimum is not None:
+      stats["min"] = extremum(np.fmin, np.inf, minimum)
+    if instant is not None:
+      stats["peak5"] = extremum(np.fmax, -np.inf, instant)
+
+    # Bin center positions for labels (the first row is the top one)
+    cx = (cells % xbins*xSize+xSize/2).astype(int)
+    cy = ((ybins-1-cells // xbins)*ySize+ySize/2).astype(int)
+    centers = np.column_stack((cx, cy))
 
-    # Initialize dictionaries
-    hist = [[0.0 for x in xrange(xbins)] for y in xrange(ybins)]
-    mask = [[1 for x in xrange(xbins)] for y in xrange(ybins)]
-    avg = [[0.0 for x in xrange(xbins)] for y in xrange(ybins)]
-    centers = [[centerbin(x,y) for x in xrange(xbins)] for y in xrange(ybins)]
+    extent = (x_min,x_max,y_min,y_max)
+    return cells, stats, extent, centers
+
+# One statistic of the binning, in peak mode only the cells with a positive
+# value are kept (like the former peak binning)
+def rectangularBinSelect(cells, stats, centers, statistic, peak = False):
+    values = stats[statistic]
+    occupied = stats["count"] > 0
+    if peak:
+      occupied &= values > 0.0
+    return cells[occupied], values[occupied], centers[occupied]
+
+# Image of the binning for imshow, only the occupied cells are filled
+def rectangularBinRaster(cells, values, xbins, ybins):
+    raster = np.empty(xbins*ybins)
+    raster.fill(np.nan)
+    raster[cells] = values
+    return np.ma.masked_invalid(raster.reshape(ybins, xbins))
 
-    # Compute histogram
-    for i in range(len(data)):
-      x,y,c = data[i]
-      xb = dLon[i] - 1
-      yb = ybins - dLat[i]
-      if peak:
-        if c > avg[yb][xb]:
-          hist[yb][xb] = 1 # count per rectangles
-          avg[yb][xb] = c  # total value per rectangles
-      else:
-        hist[yb][xb] += 1 # count per rectangles
-        avg[yb][xb] += c  # total value per rectangles
+@trace(debugMode)
+def rectangularBinNumpy(x_min,y_min,x_max,y_max, data, xbins,ybins=None):
+    # data = (x, y, value[, instant value]) columns
+    if (ybins == None): ybins = xbins
+    columns = [np.asarray(c, dtype=np.float64) for c in data]
+    xdata, ydata, cpm = columns[:3]
+    instant = None
+    if len(columns) > 3:
+      instant = columns[3]
 
-    # Compute average and mask
-    for xb in range(xbins):
-      for yb in range(ybins):
-        if hist[yb][xb] > 0.0:
-          mask[yb][xb] = 0 # mask out
-          if peak:
-            hist[yb][xb] = float(avg[yb][xb])
-          else:
-            hist[yb][xb] = (float(avg[yb][xb])/float(hist[yb][xb])) # average
+    # Bins
+    binsLon, binsLat = rectangularBinEdges(x_min,y_min,x_max,y_max, xbins,ybins)
+    index = rectangularBinIndex(np.digitize(xdata, binsLon), np.digitize(ydata, binsLat), xbins, ybins)
+    return rectangularBinReduce(x_min,y_min,x_max,y_max, index, None, cpm, cpm, cpm, instant, xbins, ybins)
 
-    extent = (x_min,x_max,y_min,y_max)
-    return hist, mask, extent, centers
+# Same as rectangularBinNumpy from per cell results
+# (digitized x, digitized y, count, sum, max[, min[, instant max]])
+def rectangularBinCells(x_min,y_min,x_max,y_max, cells, xbins,ybins=None):
+    if (ybins == None): ybins = xbins
+    dLon, dLat, count, total, maximum = cells[:5]
+    optional = [np.asarray(c, dtype=np.float64) for c in cells[5:]] + [None, None]
+    index = rectangularBinIndex(dLon, dLat, xbins, ybins)
+    return rectangularBinReduce(x_min,y_min,x_max,y_max, index,
+      np.asarray(count, dtype=np.float64), np.asarray(total, dtype=np.float64), np.asarray(maximum, dtype=np.float64),
+      optional[0], optional[1], xbins, ybins)
 
 def rectangularBinFloat(x_min,y_min,x_max,y_max, data, xbins,ybins=None):
     if (ybins == None): ybins = xbins
@@ -778,6 +1865,90 @@ def rectangularBinFloat(x_min,y_min,x_max,y_max, data, xbins,ybins=None):
     extent = (x_min,x_max,y_min,y_max)
     return hist, mask, extent, centers
 
+# -----------------------------------------------------------------------------
+# Readings labels (one raster layer composited from a glyph cache)
+# -----------------------------------------------------------------------------
+labelFonts = {}  # font size in pixels -> PIL font
+labelGlyphs = {} # (text, font size, halo) -> (RGBA glyph, x center, y center)
+
+def labelFont(size):
+    font = labelFonts.get(size)
+    if font is None:
+      from matplotlib.font_manager import findfont, FontProperties
+      font = ImageFont.truetype(findfont(FontProperties(weight="bold")), size)
+      labelFonts[size] = font
+    return font
+
+# Black text with a white halo (same look as the withStroke path effect)
+def labelGlyph(text, size, halo):
+    key = (text, size, halo)
+    glyph = labelGlyphs.get(key)
+    if glyph is None:
+      font = labelFont(size)
+      w, h = font.getsize(text)
+      mask = Image.new("L", (w+2*halo+2, h+2*halo+2), 0)
+      ImageDraw.Draw(mask).text((halo+1, halo+1), text, font=font, fill=255)
+      box = mask.getbbox()
+      if box is None:
+        glyph = (None, 0, 0)
+      else:
+        image = Image.new("RGBA", mask.size, (255, 255, 255, 0))
+        image.putalpha(mask.filter(ImageFilter.MaxFilter(2*halo+1)))
+        image.paste((0, 0, 0, 255), (0, 0)+mask.size, mask)
+        glyph = (image, (box[0]+box[2])/2.0, (box[1]+box[3])/2.0)
+      labelGlyphs[key] = glyph
+    return glyph
+
+# Draw the labels of the occupied cells as a single image on the axes
+# (centers in data coordinates), returns None if nothing is drawn
+def drawLabelLayer(ax, centers, values, fontsize, labelsize, dpi):
+    size = int(round(fontsize*dpi/72.0))
+    if size < 1 or labelsize < 1 or not len(values):
+      return None # smaller than a pixel or empty labels
+    halo = max(1, int(round(0.5*dpi/72.0)))
+
+    # Axes size in pixels when saved at dpi (the layer is drawn 1:1)
+    fig = ax.figure
+    locator = ax.get_axes_locator()
+    if locator:
+      ax.apply_aspect(locator(ax, fig.canvas.get_renderer()))
+    else:
+      ax.apply_aspect()
+    position = ax.get_position()
+    figWidth, figHeight = fig.get_size_inches()
+    width = max(1, int(round(position.width*figWidth*dpi)))
+    height = max(1, int(round(position.height*figHeight*dpi)))
+
+    # Margin for the labels on the border (clipped by the axes)
+    x0, x1 = ax.get_xlim()
+    y0, y1 = ax.get_ylim()
+    margin = 4*size
+    # paste() rather than alpha_composite() (Pillow 4.2): the glyphs are only
+    # white around the text so they are blended over white, the alpha band is
+    # accumulated apart
+    layer = Image.new("RGBA", (width+2*margin, height+2*margin), (255, 255, 255, 0))
+    alpha = Image.new("L", layer.size, 0)
+    px = (np.asarray(centers[:,0], dtype=np.float64)-x0)*width/(x1-x0) + margin
+    py = (y1-np.asarray(centers[:,1], dtype=np.float64))*height/(y1-y0) + margin
+    for x, y, v in zip(px.tolist(), py.tolist(), values.tolist()):
+      value = "%0.3f" % v
+      value = value.lstrip("0")[:labelsize]
+      glyph, cx, cy = labelGlyph(value, size, halo)
+      if glyph is None:
+        continue
+      left, top = int(round(x-cx)), int(round(y-cy))
+      if left < 0 or top < 0 or left+glyph.size[0] > layer.size[0] or top+glyph.size[1] > layer.size[1]:
+        continue
+      layer.paste(glyph, (left, top), glyph)
+      alpha.paste(255, (left, top, left+glyph.size[0], top+glyph.size[1]), glyph)
+    layer.putalpha(alpha)
+
+    # The layer extent goes beyond the limits, keep the map limits
+    dx = margin*(x1-x0)/width
+    dy = margin*(y1-y0)/height
+    ax.set_autoscale_on(False)
+    return ax.imshow(np.asarray(layer), extent=(x0-dx, x1+dx, y0-dy, y1+dy), interpolation='nearest', zorder=3)
+
 # -----------------------------------------------------------------------------
 # Hayakawa-san colormap
 # -----------------------------------------------------------------------------
@@ -851,59 +2022,437 @@ class GoogleProjection:
         return ([l0[0], l1[0]], [l0[1], l1[1]])
 
 # -----------------------------------------------------------------------------
-# Download a tile
+# Download the tiles (thread pool, keep-alive connections per host)
 # -----------------------------------------------------------------------------
-def download(url, output):
-    if (not os.path.exists(output)):
-      print "Downloading tile %s" % (output)
-      urllib.urlretrieve(url, output)
-    else:
-      print "Re-using tile %s" % (output)
+tileUrl = "http://a.tile.openstreetmap.org/{z}/{x}/{y}.png"
+#tileUrl = "http://tile.stamen.com/watercolor/{z}/{x}/{y}.png"
+#tileUrl = "http://tile.stamen.com/toner/{z}/{x}/{y}.png"
+tileWorkers = 8 # concurrent tile downloads
+tileHostConnections = 2 # connections per tile server (usage policies)
+tileTimeout = 20 # seconds
+tileRetries = 3 # attempts after the first one
+tileRetryDelay = 0.5 # seconds, doubled after each attempt
+tileUserAgent = "bgeigie_report"
+
+class TileFetcher:
+    def __init__(self, workers = tileWorkers, hostConnections = tileHostConnections, timeout = tileTimeout, retries = tileRetries, retryDelay = tileRetryDelay):
+      self.workers = max(1, workers)
+      self.hostConnections = max(1, hostConnections)
+      self.timeout = timeout
+      self.retries = retries
+      self.retryDelay = retryDelay
+      self.lock = threading.Lock()
+      self.hosts = {} # (scheme, host) -> (semaphore, idle connections)
+      self.pid = os.getpid()
+
+    def host(self, scheme, netloc):
+      with self.lock:
+        if (scheme, netloc) not in self.hosts:
+          self.hosts[(scheme, netloc)] = (threading.Semaphore(self.hostConnections), [])
+        return self.hosts[(scheme, netloc)]
+
+    def connect(self, scheme, netloc):
+      # New connection to a host (overridden by the tests to count them)
+      if scheme == "https":
+        return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+      return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def request(self, url):
+      # GET on an idle connection of the host (or a new one), kept open
+      # for the next tiles if the server allows it
+      scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+      if query:
+        path += "?" + query
+      semaphore, idle = self.host(scheme, netloc)
+      semaphore.acquire()
+      try:
+        with self.lock:
+          connection = idle and idle.pop() or None
+        if connection is None:
+          connection = self.connect(scheme, netloc)
+        try:
+          connection.request("GET", path or "/", headers={"User-Agent": tileUserAgent})
+          response = connection.getresponse()
+          body = response.read()
+        except:
+          connection.close()
+          raise
+        if response.will_close:
+          connection.close()
+        else:
+          with self.lock:
+            idle.append(connection)
+        return response.status, body
+      finally:
+        semaphore.release()
+
+    def fetch(self, url):
+      # Tile data, None if it can't be downloaded
+      delay = self.retryDelay
+      for attempt in range(self.retries+1):
+        try:
+          status, body = self.request(url)
+          if status == 200:
+            return body
+          error = "HTTP %d" % status
+          if status < 500 and status != 429:
+            break # missing tile, no retry
+        except (IOError, httplib.HTTPException), e:
+          error = str(e) or e.__class__.__name__
+        if attempt < self.retries:
+          sleep(delay)
+          delay *= 2
+      print "- tile %s not downloaded (%s)" % (url, error)
+      return None
+
+    def fetchAll(self, urls):
+      # Tiles data in the same order (None if not downloaded)
+      if not urls:
+        return []
+      pool = ThreadPool(min(self.workers, len(urls)))
+      try:
+        return pool.map(self.fetch, urls)
+      finally:
+        pool.close()
+        pool.join()
+
+    def close(self):
+      with self.lock:
+        for semaphore, idle in self.hosts.values():
+          for connection in idle:
+            connection.close()
+          del idle[:]
+
+tileFetcher = None # shared by all the maps of the process
+
+def getTileFetcher():
+    # One fetcher per process (connections can't be shared after a fork)
+    global tileFetcher
+    if tileFetcher is None or tileFetcher.pid != os.getpid():
+      tileFetcher = TileFetcher(tileWorkers)
+    return tileFetcher
+
+# -----------------------------------------------------------------------------
+# Tile cache (MBTiles like SQLite file, least recently used tiles evicted)
+# -----------------------------------------------------------------------------
+tileCacheFile = os.path.join(dataFolder, "tiles", "tiles.mbtiles")
+tileCacheMaxSize = 512*1024*1024 # bytes of tile data
+tileCacheMaxCount = 0 # tiles, 0 = no limit
+tileCacheExpiry = 30*24*3600 # seconds, older tiles are downloaded again
+tileSizeEstimate = 20*1024 # bytes per tile while the cache is empty
+
+# MBTiles rows are numbered from the south (TMS)
+def mbtilesRow(zoom, y):
+    return (1 << zoom)-1-y
+
+class TileCache:
+    def __init__(self, path, maxSize = tileCacheMaxSize, maxCount = tileCacheMaxCount, expiry = tileCacheExpiry):
+      self.path = path
+      self.maxSize = maxSize
+      self.maxCount = maxCount
+      self.expiry = expiry
+      try:
+        os.makedirs(os.path.dirname(self.path))
+      except OSError:
+        pass # already created
+      self.db = sqlite3.connect(self.path, timeout=60) # shared with the other workers
+      self.db.text_factory = str
+      self.db.execute("PRAGMA auto_vacuum = INCREMENTAL") # only before the tables are created
+      self.db.execute("PRAGMA journal_mode = WAL") # readers not blocked by the writing workers
+      # The other workers may create the tables meanwhile (schema changed
+      # under the script), they exist the next time
+      for attempt in range(3):
+        try:
+          self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,
+              tile_data BLOB, size INTEGER, created INTEGER, accessed INTEGER,
+              PRIMARY KEY (zoom_level, tile_column, tile_row));
+            CREATE INDEX IF NOT EXISTS tiles_accessed ON tiles (accessed);
+            INSERT OR IGNORE INTO metadata VALUES ('name', 'bgeigie_report tiles');
+            INSERT OR IGNORE INTO metadata VALUES ('format', 'png');
+          """)
+          self.db.commit()
+          break
+        except sqlite3.OperationalError:
+          if attempt == 2:
+            raise
+          sleep(0.1)
+      self.pid = os.getpid()
+
+    def key(self, zoom, x, y):
+      return (zoom, x, mbtilesRow(zoom, y))
+
+    def get(self, zoom, x, y, stale = False):
+      # Tile data (None if missing or expired), see touch()
+      now = calendar.timegm(gmtime())
+      row = self.db.execute("SELECT tile_data, created FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+        self.key(zoom, x, y)).fetchone()
+      if row is None or (not stale and self.expiry and row[1] < now-self.expiry):
+        return None
+      return str(row[0])
+
+    def touch(self, zoom, tiles):
+      # tiles = [(x, y)] used, marked as recently used at once
+      if not tiles:
+        return
+      now = calendar.timegm(gmtime())
+      self.db.executemany("UPDATE tiles SET accessed=? WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+        [(now,)+self.key(zoom, x, y) for x, y in tiles])
+      self.db.commit()
+
+    def put(self, tiles):
+      # tiles = [(zoom, x, y, data)] stored at once, then the budget is enforced
+      now = calendar.timegm(gmtime())
+      self.db.executemany("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?)",
+        [self.key(zoom, x, y)+(sqlite3.Binary(data), len(data), now, now) for zoom, x, y, data in tiles])
+      self.db.commit()
+      self.evict()
+
+    def averageSize(self):
+      # Bytes per tile (tileSizeEstimate if empty)
+      size = self.db.execute("SELECT AVG(size) FROM tiles").fetchone()[0]
+      return size or tileSizeEstimate
+
+    def evict(self):
+      # Least recently used tiles first
+      count, total = self.db.execute("SELECT COUNT(*), SUM(size) FROM tiles").fetchone()
+      total = total or 0
+      if total <= self.maxSize and (not self.maxCount or count <= self.maxCount):
+        return
+      removed = []
+      for rowid, size in self.db.execute("SELECT rowid, size FROM tiles ORDER BY accessed"):
+        if total <= self.maxSize and (not self.maxCount or count <= self.maxCount):
+          break
+        removed.append((rowid,))
+        total -= size
+        count -= 1
+      self.db.executemany("DELETE FROM tiles WHERE rowid=?", removed)
+      self.db.commit()
+      self.db.execute("PRAGMA incremental_vacuum")
+      print "[TILES] %d tiles removed from %s" % (len(removed), self.path)
+
+    def close(self):
+      self.db.close()
+
+tileCache = None # shared by all the maps of the process
+
+def getTileCache():
+    # One connection per process (can't be used after a fork)
+    global tileCache
+    if tileCache is None or tileCache.pid != os.getpid():
+      tileCache = TileCache(tileCacheFile, tileCacheMaxSize, tileCacheMaxCount, tileCacheExpiry)
+    return tileCache
+
+# -----------------------------------------------------------------------------
+# Tile sources (tile server, MBTiles file or folder of tiles)
+# -----------------------------------------------------------------------------
+tileSource = tileUrl # URL template, .mbtiles file or folder ({z}/{x}/{y}.png)
+
+class HttpTileSource:
+    cached = True # downloaded tiles are kept in the tile cache
+
+    def __init__(self, url):
+      self.url = url
+
+    def fetchAll(self, zoom, tiles):
+      urls = [self.url.format(z=int(zoom), x=int(x), y=int(y)) for x, y in tiles]
+      return getTileFetcher().fetchAll(urls)
+
+class MBTilesTileSource:
+    cached = False
+
+    def __init__(self, path):
+      if not os.path.exists(path):
+        raise IOError("No tile file %s" % path)
+      self.path = path
+      self.db = sqlite3.connect(path, timeout=60)
+      self.db.text_factory = str
+
+    def fetchAll(self, zoom, tiles):
+      data = []
+      for x, y in tiles:
+        row = self.db.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+          (zoom, x, mbtilesRow(zoom, y))).fetchone()
+        data.append(row and str(row[0]) or None)
+      return data
+
+class DirectoryTileSource:
+    cached = False
+
+    def __init__(self, path):
+      if "{z}" not in path:
+        path = os.path.join(path, "{z}", "{x}", "{y}.png")
+      self.path = path
+
+    def fetchAll(self, zoom, tiles):
+      data = []
+      for x, y in tiles:
+        try:
+          with open(self.path.format(z=int(zoom), x=int(x), y=int(y)), "rb") as f:
+            data.append(f.read())
+        except IOError:
+          data.append(None)
+      return data
+
+def openTileSource(source):
+    if source.startswith("http://") or source.startswith("https://"):
+      return HttpTileSource(source)
+    if os.path.splitext(source)[1].lower() in (".mbtiles", ".db", ".sqlite"):
+      return MBTilesTileSource(source)
+    return DirectoryTileSource(source)
+
+tileSourceInstance = None # shared by all the maps of the process
+
+def getTileSource():
+    # One source per process (connections can't be shared after a fork)
+    global tileSourceInstance
+    if tileSourceInstance is None or tileSourceInstance[0] != os.getpid():
+      tileSourceInstance = (os.getpid(), openTileSource(tileSource))
+    return tileSourceInstance[1]
+
+def configureTiles(options):
+    global tileSource, tileWorkers, tileFetcher, tileCacheFile, tileCacheMaxSize, tileCache, tileSourceInstance
+    tileSource = getattr(options, "tileSource", None) or tileSource
+    tileWorkers = getattr(options, "tileJobs", None) or tileWorkers
+    tileCacheFile = getattr(options, "tileCache", None) or tileCacheFile
+    if getattr(options, "tileCacheSize", None) is not None:
+      tileCacheMaxSize = int(options.tileCacheSize*1024*1024)
+    tileFetcher = None
+    tileCache = None
+    tileSourceInstance = None
+
+def downloadTiles(zoom, tiles):
+    # tiles = [(x, y)], data from the cache or the source (concurrent downloads),
+    # an expired tile is still used if it can't be downloaded again
+    source = getTileSource()
+    if not source.cached:
+      return source.fetchAll(zoom, tiles)
+    cache = getTileCache()
+    data = [cache.get(zoom, x, y) for x, y in tiles]
+    missing = [i for i, d in enumerate(data) if d is None]
+    used = [tile for tile, d in zip(tiles, data) if d is not None]
+    downloaded = []
+    if missing:
+      print "Downloading %d tiles (%d re-used)" % (len(missing), len(tiles)-len(missing))
+      for i, d in zip(missing, source.fetchAll(zoom, [tiles[i] for i in missing])):
+        if d is None:
+          data[i] = cache.get(zoom, tiles[i][0], tiles[i][1], stale=True)
+          if data[i] is not None:
+            used.append(tiles[i])
+        else:
+          data[i] = d
+          downloaded.append((zoom, tiles[i][0], tiles[i][1], d))
+    # The tiles re-used are marked before the new ones can evict them
+    cache.touch(zoom, used)
+    if downloaded:
+      cache.put(downloaded)
+    return data
+
+# Tiles (top left and bottom right) covering an area
+def tileRange(lat_min,lon_min,lat_max,lon_max, zoom):
+    projection = GoogleProjection()
+    gx0 , gy0 = projection.fromLLtoPixel((lon_min, lat_max), zoom) # top left
+    gx1 , gy1 = projection.fromLLtoPixel((lon_max, lat_min), zoom) # bottom right
+    return int(gx0/256), int(gy0/256), int(gx1/256), int(gy1/256)
+
+# Fill the tile cache of an area for a range of zooms (offline maps), returns
+# False if the tiles would not fit in the cache (the first ones evicted)
+def prewarmTiles(lat_min,lon_min,lat_max,lon_max, zoomMin, zoomMax, batchSize = 1024):
+    ranges = [(zoom,)+tileRange(lat_min,lon_min,lat_max,lon_max, zoom) for zoom in range(zoomMin, zoomMax+1)]
+    count = sum([(gx1-gx0+1)*(gy1-gy0+1) for zoom, gx0, gy0, gx1, gy1 in ranges])
+    if getTileSource().cached:
+      size = count*getTileCache().averageSize()
+      print "[TILES] %d tiles, about %.1f MB" % (count, size/1048576.0)
+      if size > tileCacheMaxSize or (tileCacheMaxCount and count > tileCacheMaxCount):
+        print "- more tiles than the cache can keep (%.1f MB), increase --tile-cache-size or reduce the area or the zoom range" % (tileCacheMaxSize/1048576.0)
+        return False
+    for zoom, gx0, gy0, gx1, gy1 in ranges:
+      print "[TILES] zoom %d: %d tiles" % (zoom, (gx1-gx0+1)*(gy1-gy0+1))
+      batch = []
+      missing = 0
+      for gx in range(gx0, gx1+1):
+        for gy in range(gy0, gy1+1):
+          batch.append((gx % (1 << zoom), gy))
+          if len(batch) == batchSize or (gx == gx1 and gy == gy1):
+            missing += len([d for d in downloadTiles(zoom, batch) if d is None])
+            batch = []
+      if missing:
+        print "- %d tiles not available" % missing
+    return True
+
+# Decoded tiles kept for the next maps of the process (adjacent chunks), and
+# inherited by the chunk workers (see shareTiles)
+tileImagesMaxCount = 256 # tiles (192 KB each)
+tileImages = OrderedDict() # (zoom, x, y) -> image, least recently used first
+
+def decodedTiles(zoom, tiles):
+    images = [None]*len(tiles)
+    missing = []
+    for i, (x, y) in enumerate(tiles):
+      image = tileImages.pop((zoom, x, y), None)
+      if image is None:
+        missing.append(i)
+      else:
+        tileImages[(zoom, x, y)] = image # most recently used
+        images[i] = image
+
+    # Missing tiles are left blank
+    if not missing:
+      return images
+    data = downloadTiles(zoom, [tiles[i] for i in missing])
+    for i, d in zip(missing, data):
+      if d is None:
+        continue
+      try:
+        image = Image.open(StringIO(d))
+        image.load()
+      except IOError:
+        print "- tile %d/%d/%d can't be decoded" % ((zoom,)+tiles[i])
+        continue
+      images[i] = tileImages[(zoom,)+tiles[i]] = image
+    while len(tileImages) > tileImagesMaxCount:
+      tileImages.popitem(last=False)
+    return images
+
+# Decode the tiles shared by several maps before their workers are forked,
+# areas = [(lat_min, lon_min, lat_max, lon_max, zoom)]
+def shareTiles(areas):
+    counts = {}
+    for lat_min, lon_min, lat_max, lon_max, zoom in areas:
+      gx0, gy0, gx1, gy1 = tileRange(lat_min,lon_min,lat_max,lon_max, zoom)
+      for gx in range(gx0, gx1+1):
+        for gy in range(gy0, gy1+1):
+          key = (zoom, gx % (1 << zoom), gy)
+          counts[key] = counts.get(key, 0) + 1
+    shared = sorted([key for key, count in counts.items() if count > 1])[:tileImagesMaxCount]
+    for zoom in sorted(set([key[0] for key in shared])):
+      decodedTiles(zoom, [(x, y) for z, x, y in shared if z == zoom])
+    return len(shared)
 
 # -----------------------------------------------------------------------------
-# Load OSM tiles from an area
+# Load OSM tiles from an area (mosaic image and its corners)
 # -----------------------------------------------------------------------------
 @trace(debugMode)
 def loadTiles(lat_min,lon_min,lat_max,lon_max, zoom):
     projection = GoogleProjection()
-    gx0 , gy0 = projection.fromLLtoPixel((lon_min, lat_max), zoom) # top right
-    gx1 , gy1 = projection.fromLLtoPixel((lon_max, lat_min), zoom) # bottom left
-
-    gx0 = int(gx0/256)
-    gy0 = int(gy0/256)
-    gx1 = int(gx1/256)
-    gy1 = int(gy1/256)
+    gx0, gy0, gx1, gy1 = tileRange(lat_min,lon_min,lat_max,lon_max, zoom)
 
     tilesX = gx1-gx0+1
     tilesY = gy1-gy0+1
 
-    if not os.path.exists(dataFolder+"/tiles/%s" % zoom):
-      os.makedirs(dataFolder+"/tiles/%s" % zoom)
-
-    # Start looping
-    gx = gx0
-    gy = gy0
-    images = []
-    while (gx <= gx1):
-      images_horizontal = []
-      while (gy <= gy1):
+    # Get the tiles at once (cache or download)
+    tiles = []
+    for gx in range(gx0, gx1+1):
+      for gy in range(gy0, gy1+1):
         X = gx % (1 << zoom)
-        filename = dataFolder+"/tiles/%s/%d-%d.png" % (zoom, gx, gy)
-        pngurl = "http://a.tile.openstreetmap.org/%d/%d/%d.png" % (int(zoom), int(X), int(gy))
-        #pngurl = "http://tile.stamen.com/watercolor/%d/%d/%d.png" % (int(zoom), int(X), int(gy))
-        #pngurl = "http://tile.stamen.com/toner/%d/%d/%d.png" % (int(zoom), int(X), int(gy))
-
-        download(pngurl, filename)
+        tiles.append((X, gy))
+    decoded = decodedTiles(zoom, tiles)
 
-        image = Image.open(filename)
-        image.load()
-        images_horizontal.append((filename, image))
-
-        gy += 1
-
-      images.append(images_horizontal)
-      gy = gy0
-      gx += 1
+    # Column by column
+    images = []
+    for x in range(tilesX):
+      images.append(decoded[x*tilesY:(x+1)*tilesY])
 
     # Merge tiles
     spriteSheet = Image.new('RGB', (tilesX*256, tilesY*256), (0, 0, 0, 0))
@@ -913,20 +2462,38 @@ def loadTiles(lat_min,lon_min,lat_max,lon_max, zoom):
     for x in range(tilesX):
       pasteY = 0
       for y in range(tilesY):
-        (filename, image) = images[x][y]
-        spriteSheet.paste(image, (pasteX, pasteY))
+        image = images[x][y]
+        if image is not None:
+          spriteSheet.paste(image, (pasteX, pasteY))
         pasteY += 256
       pasteX += 256
 
-    filename = random_filename(suffix=".png")
-    spriteSheet.save(os.path.join(tempfile.gettempdir(), filename), quality=50)
-
     c = projection.corners(gx0 , gy0, gx1 , gy1, zoom)
-    return filename, c
+    return spriteSheet, c
+
+# Crop the mosaic (extent in map coordinates) to an area and resample it once
+# to at most size pixels, returns the image and its extent
+def cropTiles(image, extent, area, size):
+    xmin, xmax, ymin, ymax = extent
+    sx = image.size[0]/float(xmax-xmin)
+    sy = image.size[1]/float(ymax-ymin)
+    left = max(0, int(math.floor((area[0]-xmin)*sx))-1)
+    right = min(image.size[0], int(math.ceil((area[1]-xmin)*sx))+1)
+    top = max(0, int(math.floor((ymax-area[3])*sy))-1)
+    bottom = min(image.size[1], int(math.ceil((ymax-area[2])*sy))+1)
+    if right <= left or bottom <= top:
+      return image, extent
+    image = image.crop((left, top, right, bottom))
+    extent = (xmin+left/sx, xmin+right/sx, ymax-bottom/sy, ymax-top/sy)
+
+    scale = min(1.0, float(size[0])/image.size[0], float(size[1])/image.size[1])
+    if scale < 1.0:
+      image = image.resize((max(1, int(round(image.size[0]*scale))), max(1, int(round(image.size[1]*scale)))), Image.ANTIALIAS)
+    return image, extent
 
 def splitMapData(data, areaSize):
   # Extract data log
-  did, dt, lat, lon, cpm, altitude, dose, skipped, model = data
+  lat, lon = data.lat, data.lon
 
   # Original dataset size
   owidth = distance_on_unit_sphere(lat.min(),lon.min(),lat.min(),lon.max())
@@ -947,58 +2514,26 @@ def splitMapData(data, areaSize):
     # print nbpagewidth, lonRange, lonArray
     # print nbpageheight, latRange, latArray
 
-    tosplit = zip(did, dt, lat, lon, cpm, altitude)
     skipped = {"U": [], "H": [], "T": [], "D": [], "O": []}
      
     for latStart in latArray:
+      inLat = (lat >= latStart) & (lat <= latStart+latRange)
       for lonStart in lonArray:
         # print latStart, lonStart, latStart+latRange, lonStart+lonRange
+        inside = np.flatnonzero(inLat & (lon >= lonStart) & (lon <= lonStart+lonRange))
+
+        print "Area", latStart, lonStart, len(inside)+2*(len(inside)>0)
+        if len(inside)>0:
+          # add dummy corners (drive and date of the first reading)
+          corners = data.readings[inside[[0, 0]]]
+          corners["lat"] = [latStart, latStart+latRange]
+          corners["lon"] = [lonStart, lonStart+lonRange]
+          corners["cpm"] = 0
+          corners["altitude"] = 0
+          corners["instant"] = 0
 
-        resultDriveId = []
-        resultDate = []
-        resultReading = []
-        resultLat = []
-        resultLon = []
-        resultAltitude = []
-
-        firstPass = True # To add corners
-
-        for (did, dt, lat, lon, cpm, altitude) in tosplit:
-          if (lat >= latStart) and (lat <= latStart+latRange) and (lon >= lonStart) and (lon <= lonStart+lonRange):
-            if firstPass:
-              # add dummy corners
-              resultDriveId.append(did)
-              resultDate.append(dt)
-              resultReading.append(0)
-              resultLat.append(latStart)
-              resultLon.append(lonStart)
-              resultAltitude.append(0)
-
-              resultDriveId.append(did)
-              resultDate.append(dt)
-              resultReading.append(0)
-              resultLat.append(latStart+latRange)
-              resultLon.append(lonStart+lonRange)
-              resultAltitude.append(0)
-
-              firstPass = False
-
-            # Store the results
-            resultDriveId.append(did)
-            resultDate.append(dt)
-            resultReading.append(cpm)
-            resultLat.append(lat)
-            resultLon.append(lon)
-            resultAltitude.append(altitude)
-
-        resultLat = np.array(resultLat)
-        resultLon = np.array(resultLon)
-        resultReading = np.array(resultReading)
-        resultAltitude = np.array(resultAltitude)
-
-        print "Area", latStart, lonStart, len(resultLat)
-        if len(resultLat)>0:
-          splitMapDataResult.append((resultDriveId, resultDate, resultLat, resultLon, resultReading, resultAltitude, dose, skipped, model))
+          readings = np.concatenate((corners, data.readings[inside]))
+          splitMapDataResult.append(Drive(readings, data.driveNames, data.dose, skipped, data.model))
 
   if (len(splitMapDataResult) == 1):
     # Once chunck can be ignored
@@ -1008,22 +2543,17 @@ def splitMapData(data, areaSize):
   return splitMapDataResult
 
 # -----------------------------------------------------------------------------
-# Draw final map (tile layer + rectangular binning 100mx100m layer)
+# Scale of a map from the statistics of its data: original size (km), entry
+# of scaleTable (None for the smallest), (zoom, font, label, dpi, bin) and the
+# area with a border (lat_min, lon_min, lat_max, lon_max)
 # -----------------------------------------------------------------------------
-@trace(debugMode)
-def drawMap(mapName, data, language, showTitle, peak=False):
-    print "Generating %s.png ..." % mapName
-
-    # Extract data log
-    did, dt, lat, lon, cpm, altitude, dose, skipped, model = data
-
-    # Original dataset size
-    owidth = distance_on_unit_sphere(lat.min(),lon.min(),lat.min(),lon.max())
-    oheight = distance_on_unit_sphere(lat.min(),lon.min(),lat.max(),lon.min())
-    print "original area %.3f km x %.3f km" % (owidth, oheight)
+def mapScale(stats):
+    owidth = distance_on_unit_sphere(stats["latMin"],stats["lonMin"],stats["latMin"],stats["lonMax"])
+    oheight = distance_on_unit_sphere(stats["latMin"],stats["lonMin"],stats["latMax"],stats["lonMin"])
 
     # Adjust label size and tiles zoom
     (zoom, fontsize, labelsize, dpi, binSize) = (16, 7, 4, 100, 0.1)
+    scale = None
 
     scales = scaleTable.keys()
     scales.sort()
@@ -1032,7 +2562,7 @@ def drawMap(mapName, data, language, showTitle, peak=False):
       if max(owidth,oheight) < s:
         continue
       else:
-       print scaleTable[s]
+       scale = s
        (zoom, fontsize, labelsize, dpi, binSize) = (
             scaleTable[s]["zoom"],
             scaleTable[s]["font"],
@@ -1042,13 +2572,31 @@ def drawMap(mapName, data, language, showTitle, peak=False):
        break
 
     # Add 100m border around the measured area
-    h100m, w100m = offset_on_unit_sphere((lat.min()+lat.max())/2,binSize*1000)
+    h100m, w100m = offset_on_unit_sphere((stats["latMin"]+stats["latMax"])/2,binSize*1000)
     if (not owidth): w100m *= 1.5
     if (not oheight): h100m *= 1.5
-    lon_min = lon.min()-borderSize*w100m
-    lon_max = lon.max()+borderSize*w100m
-    lat_min = lat.min()-borderSize*h100m
-    lat_max = lat.max()+borderSize*h100m
+    lon_min = stats["lonMin"]-borderSize*w100m
+    lon_max = stats["lonMax"]+borderSize*w100m
+    lat_min = stats["latMin"]-borderSize*h100m
+    lat_max = stats["latMax"]+borderSize*h100m
+    return owidth, oheight, scale, (zoom, fontsize, labelsize, dpi, binSize), (lat_min, lon_min, lat_max, lon_max)
+
+# -----------------------------------------------------------------------------
+# Draw final map (tile layer + rectangular binning 100mx100m layer)
+# -----------------------------------------------------------------------------
+@trace(debugMode)
+def drawMap(mapName, data, language, showTitle, peak=False, variants=None):
+    print "Generating %s.png ..." % mapName
+
+    # Extract data log
+    stats = data.statistics()
+    dose, skipped, model = data.dose, data.skipped, data.model
+
+    # Original dataset size, tiles zoom and label size, area with a border
+    owidth, oheight, scale, (zoom, fontsize, labelsize, dpi, binSize), (lat_min, lon_min, lat_max, lon_max) = mapScale(stats)
+    print "original area %.3f km x %.3f km" % (owidth, oheight)
+    if scale is not None:
+      print scaleTable[scale]
 
     # Compute gridsize
     width = distance_on_unit_sphere(lat_min,lon_min,lat_min,lon_max)
@@ -1068,15 +2616,14 @@ def drawMap(mapName, data, language, showTitle, peak=False):
     #print svgUrl
 
     # Compute title and statistic informations
-    dt.sort()
-    startZ = datetime.strptime(dt[0], '%Y-%m-%dT%H:%M:%SZ')
-    stopZ = datetime.strptime(dt[-1], '%Y-%m-%dT%H:%M:%SZ')
-    start = startZ + timedelta(hours=+9) # GMT+9 from Zulu time
-    stop = stopZ + timedelta(hours=+9) # GMT+9 from Zulu time
+    startZ = epochToDatetime(stats["timeMin"])
+    stopZ = epochToDatetime(stats["timeMax"])
+    start = startZ + timedelta(hours=JSTOffset) # GMT+9 from Zulu time
+    stop = stopZ + timedelta(hours=JSTOffset) # GMT+9 from Zulu time
     title = "%s\n(%s -> %s)" % (mapName, start.strftime("%Y/%m/%d %H:%M"), stop.strftime("%Y/%m/%d %H:%M"))
-    statistics = u"area %.3f km x %.3f km | min %.3f µSv/h, max %.3f µSv/h, avg %.3f µSv/h | dose %.3f µSv" % (width, height, float(cpm.min()), float(cpm.max()), float(cpm.mean()), float(dose))
+    statistics = u"area %.3f km x %.3f km | min %.3f µSv/h, max %.3f µSv/h, avg %.3f µSv/h | dose %.3f µSv" % (width, height, float(stats["cpmMin"]), float(stats["cpmMax"]), float(stats["cpmMean"]), float(dose))
 
-    statTable=[(sLabels["points"][language], len(cpm)),
+    statTable=[(sLabels["points"][language], stats["points"]),
                (sLabels["start"][language],start),
                (sLabels["stop"][language],"%s (%d minutes)" % (stop, minutes_difference(stopZ, startZ))),
                (sLabels["covered"][language], "%.3f km x %.3f km" % (width, height)),
@@ -1084,20 +2631,20 @@ def drawMap(mapName, data, language, showTitle, peak=False):
                (sLabels["south"][language], ("%.6f" % lat_min)),
                (sLabels["west"][language], ("%.6f" % lon_min)),
                (sLabels["east"][language], ("%.6f" % lon_max)),
-               (sLabels["rmax"][language], ("%.3f" % cpm.max()).lstrip("0")),
-               (sLabels["ravg"][language], ("%.3f" % cpm.mean()).lstrip("0")),
-               (sLabels["rmin"][language], ("%.3f" % cpm.min()).lstrip("0")),
+               (sLabels["rmax"][language], ("%.3f" % stats["cpmMax"]).lstrip("0")),
+               (sLabels["ravg"][language], ("%.3f" % stats["cpmMean"]).lstrip("0")),
+               (sLabels["rmin"][language], ("%.3f" % stats["cpmMin"]).lstrip("0")),
 #               ("Total dose (µSv)", ("%.3f" % dose).lstrip("0")),
-               (sLabels["aavg"][language], ("%.3f" % altitude.mean()).lstrip("0")),
-               (sLabels["amin"][language], ("%.3f" % altitude.min()).lstrip("0")),
-               (sLabels["amax"][language], ("%.3f" % altitude.max()).lstrip("0")),
+               (sLabels["aavg"][language], ("%.3f" % stats["altitudeMean"]).lstrip("0")),
+               (sLabels["amin"][language], ("%.3f" % stats["altitudeMin"]).lstrip("0")),
+               (sLabels["amax"][language], ("%.3f" % stats["altitudeMax"]).lstrip("0")),
     ]
 
     if model != "":
       statTable+=[(sLabels["model"][language], ("%s" % model))]
 
     # Load tiles
-    tilename, (ctilesLon, ctilesLat) = loadTiles(lat_min,lon_min,lat_max,lon_max, zoom)
+    tiles, (ctilesLon, ctilesLat) = loadTiles(lat_min,lon_min,lat_max,lon_max, zoom)
 
     # Create the basemap
     print "create the basemap ..."
@@ -1106,8 +2653,9 @@ def drawMap(mapName, data, language, showTitle, peak=False):
     # Compute Hayakawa-san color map
     levels, cmap, normCPM = JPsafecast_cmap()
 
-    # Project the measurements
-    x,y = m(lon,lat)
+    # Project the measurements (the database readings are only binned)
+    if isinstance(data, Drive):
+      x,y = m(data.lon,data.lat)
 
     # Disable axis, strip unecessary
     plt.setp(plt.gca(), frame_on=False, xticks=[], yticks=[])
@@ -1115,70 +2663,86 @@ def drawMap(mapName, data, language, showTitle, peak=False):
     if showTitle:
       plt.title(title, fontsize=10)
 
-    # Add the OSM map
+    # Add the OSM map (only the map area at the page resolution)
     print "add OSM layer ..."
+    x_min,y_min = m(lon_min,lat_min)
+    x_max,y_max = m(lon_max,lat_max)
     tx,ty = m(ctilesLon,ctilesLat)
     xmin,xmax = min(tx),max(tx)
     ymin,ymax = min(ty),max(ty)
-    tilesExtent = (xmin,xmax,ymin,ymax)
-    tiles = Image.open(os.path.join(tempfile.gettempdir(),tilename)) #.transpose(Image.FLIP_TOP_BOTTOM)
+    pageSize = max(plt.gcf().get_size_inches())*dpi
+    tiles, tilesExtent = cropTiles(tiles, (xmin,xmax,ymin,ymax), (x_min,x_max,y_min,y_max), (int(math.ceil(pageSize)), int(math.ceil(pageSize*height/width))))
     plt.imshow(tiles, extent = tilesExtent, alpha = 0.8)
 
     # Draw Safecast data on the map
-    m.scatter(x, y, s=0.1, c=cpm, cmap=cmap, linewidths=0.1, alpha=0.1, facecolors='none', norm=normCPM)
+    if isinstance(data, Drive):
+      m.scatter(x, y, s=0.1, c=data.cpm, cmap=cmap, linewidths=0.1, alpha=0.1, facecolors='none', norm=normCPM)
     #m.scatter(x, y, s=3, c=cpm, cmap=cmap, linewidths=0.1, alpha=1, norm=normCPM, zorder = 5)
 
-    # Draw the rectangle binning
+    # Draw the rectangle binning (all the statistics in one pass)
     print "add binning layer ..."
-    x_min,y_min = m(lon_min,lat_min)
-    x_max,y_max = m(lon_max,lat_max)
-    imdata, mask, extent, centers = rectangularBinNumpy(x_min,y_min,x_max,y_max,zip(x,y,cpm), gridsize[0], gridsize[1], peak = peak)
-    drive100m = np.ma.array(imdata, mask=mask)
-    plt.imshow(drive100m, extent = extent, interpolation = 'nearest', cmap=cmap, norm=normCPM, alpha = 0.9)
-
-    # Show measurement labels
-    print "add readings label ..."
-    for w in range(gridsize[0]):
-      for h in range(gridsize[1]):
-        tx, ty = centers[gridsize[1]-h-1][w]
-        if mask[h][w] == 0:
-          value = "%0.3f" % (imdata[h][w])
-          value = value.lstrip("0")
-          if len(value)>labelsize: value = value[:labelsize]
-          label = plt.text(tx,ty,value, fontsize=fontsize, ha='center',va='center',color='k', fontweight='bold')
-          plt.setp(label, path_effects=[PathEffects.withStroke(linewidth=1, foreground="w")])
-
-    # Legend
+    if isinstance(data, Drive):
+      cells, binStats, extent, centers = rectangularBinNumpy(x_min,y_min,x_max,y_max,(x,y,data.cpm,data.instant), gridsize[0], gridsize[1])
+    else:
+      cells, binStats, extent, centers = data.binning(m, x_min,y_min,x_max,y_max, gridsize[0], gridsize[1])
+
+    # One map per variant (file name, statistic, peak mode) from the same binning
+    if variants is None:
+      variants = [(mapName, peak and "max" or "mean", peak)]
     legend = sLabels["legend"][language] % (binSize*1000)
-    divider = make_axes_locatable(plt.gca())
-    cax = divider.append_axes("bottom", .2, pad=0.05)
-    cbar = plt.colorbar(cax=cax, orientation="horizontal", format=u"%0.3f~\nµSv/h")
-    if showTitle:
-       cbar.set_label(statistics, fontsize=8)
-    for tick in cbar.ax.xaxis.get_major_ticks():
-       tick.label.set_fontsize(8)
-
-    # Page size
-    DefaultSize = plt.gcf().get_size_inches()
-    MaxSize = max(DefaultSize[0], DefaultSize[1])
-    plt.gcf().set_size_inches(MaxSize, MaxSize*(height/width))
-    NewSize = plt.gcf().get_size_inches()
-    print "page size %dx%d inches" % (NewSize[0], NewSize[1])
-
-    # Save png file
-    print "save the map ..."
-    try:
-       plt.savefig(mapName+".png", dpi = dpi, bbox_inches='tight') # pad_inches=0
-    except:
-       print "- keep margins !!!"
-       plt.savefig(mapName+".png", dpi = dpi)
-    trim(Image.open(mapName+".png"), (255,255,255,255)).save(mapName+".png")
-    Image.open(mapName+".png").save(mapName+".jpg",quality=70) # create a 70% quality jpeg
+    NewSize = None
+    for variantName, statistic, variantPeak in variants:
+      if statistic not in binStats:
+        print "- %s not available, %s uses the max" % (statistic, variantName)
+        statistic = "max"
+      variantCells, values, variantCenters = rectangularBinSelect(cells, binStats, centers, statistic, variantPeak)
+      drive100m = rectangularBinRaster(variantCells, values, gridsize[0], gridsize[1])
+      layers = [plt.imshow(drive100m, extent = extent, interpolation = 'nearest', cmap=cmap, norm=normCPM, alpha = 0.9)]
+      del drive100m
+
+      if NewSize is None:
+        # Legend (the map axes stay current for the next variants)
+        mapAxes = plt.gca()
+        divider = make_axes_locatable(mapAxes)
+        cax = divider.append_axes("bottom", .2, pad=0.05)
+        cbar = plt.colorbar(cax=cax, orientation="horizontal", format=u"%0.3f~\nµSv/h")
+        if showTitle:
+           cbar.set_label(statistics, fontsize=8)
+        for tick in cbar.ax.xaxis.get_major_ticks():
+           tick.label.set_fontsize(8)
+        plt.sca(mapAxes)
+
+        # Page size
+        DefaultSize = plt.gcf().get_size_inches()
+        MaxSize = max(DefaultSize[0], DefaultSize[1])
+        plt.gcf().set_size_inches(MaxSize, MaxSize*(height/width))
+        NewSize = plt.gcf().get_size_inches()
+        print "page size %dx%d inches" % (NewSize[0], NewSize[1])
+
+      # Show measurement labels (occupied cells only, column by column)
+      print "add readings label ..."
+      order = np.lexsort((variantCells // gridsize[0], variantCells % gridsize[0]))
+      label = drawLabelLayer(mapAxes, variantCenters[order], values[order], fontsize, labelsize, dpi)
+      if label is not None:
+        layers.append(label)
+
+      # Save png file
+      print "save the map %s ..." % variantName
+      try:
+         plt.savefig(variantName+".png", dpi = dpi, bbox_inches='tight') # pad_inches=0
+      except:
+         print "- keep margins !!!"
+         plt.savefig(variantName+".png", dpi = dpi)
+      trim(Image.open(variantName+".png"), (255,255,255,255)).save(variantName+".png")
+      Image.open(variantName+".png").save(variantName+".jpg",quality=70) # create a 70% quality jpeg
+
+      # Remove the binning layers before the next variant
+      for layer in layers:
+        layer.remove()
 
     # Cleanup resources
     plt.clf() # clear the plot (free the memory for the other threads)
     pl.close('all')
-    os.remove(os.path.join(tempfile.gettempdir(),tilename))
     print "Done."
 
     return [NewSize, legend, statTable, skipped]
@@ -1349,8 +2913,8 @@ def generateHTMLReport(mapName, language, statisticTable, skipped, charset):
 def generateKMLreport(mapName, data, useZipExtension = False):
     print "Generating KML file %s.kml ..." % mapName
 
-    # Extract data log
-    readings = zip(*data[:5])
+    # Extract data log (dates in GMT+9 from Zulu time)
+    readings = data.rows("drive", lambda d: formatEpoch(d.time, JSTOffset, "/", " "), "lat", "lon", "cpm")
 
     KMLIconColors = ["white", "midgreen", "green", "lightGreen", "yellow", "orange", "darkOrange", "red", "darkRed", "grey"]
     KMLIconBins = [0, 35, 70, 105, 175, 280, 350, 420, 680, 1050]
@@ -1564,12 +3128,11 @@ def generateKMLreport(mapName, data, useZipExtension = False):
     kmlfile = open(mapName+".kml", "w")
     kmlfile.write(KMLHeader)
 
-    for did, dt, lat, lon, usv in readings:
+    for did, jpdate, lat, lon, usv in readings:
       cpm = int(usv*CPMfactor)
       icolor = np.digitize(np.array([cpm]), KMLIconBins)
-      jpdate = datetime.strptime(dt, '%Y-%m-%dT%H:%M:%SZ') + timedelta(hours=+9) # GMT+9 from Zulu time
-      kmlfile.write(KMLSimplePlaceMark % (usv, int(usv*CPMfactor), jpdate.strftime("%Y/%m/%d %H:%M:%S"), KMLIconColors[icolor[0]-1], lon, lat))
-      #kmlfile.write(KMLPlacemark % (usv, originalLogName, usv, cpm, jpdate.strftime("%Y/%m/%d %H:%M:%S"), KMLIconColors[icolor[0]-1], lon, lat))
+      kmlfile.write(KMLSimplePlaceMark % (usv, int(usv*CPMfactor), jpdate, KMLIconColors[icolor[0]-1], lon, lat))
+      #kmlfile.write(KMLPlacemark % (usv, originalLogName, usv, cpm, jpdate, KMLIconColors[icolor[0]-1], lon, lat))
 
     kmlfile.write(KMLFooter)
     kmlfile.close()
@@ -1612,7 +3175,7 @@ def generateGPXreport(mapName, data, trackMode = True):
     print "Generating GPX file %s.gpx ..." % mapName
 
     # Extract data log
-    readings = zip(*data[:6])
+    readings = data.rows("drive", lambda d: formatEpoch(d.time), "lat", "lon", "cpm", "altitude")
     GPXHeader = """<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
 <gpx xmlns="http://www.topografix.com/GPX/1/1" creator="Safecast" version="1.1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.garmin.com/xmlschemas/GpxExtensions/v3 http://www.garmin.com/xmlschemas/GpxExtensions/v3/GpxExtensionsv3.xsd http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd">
 """
@@ -1655,9 +3218,9 @@ def generateGPXreport(mapName, data, trackMode = True):
       gpxfile.write(GPXHeaderExtra % originalLogName)
     for did, dt, lat, lon, usv, alt in readings:
       if trackMode:
-        gpxfile.write(GPXPoint % (lat, lon, alt, dt))
+        gpxfile.write(GPXPoint % (lat, lon, alt, dt+"Z"))
       else:
-        gpxfile.write(GPXWayPoint % (lat, lon, alt, usv, dt, usv, int(usv*CPMfactor)))
+        gpxfile.write(GPXWayPoint % (lat, lon, alt, usv, dt+"Z", usv, int(usv*CPMfactor)))
 
     if trackMode:
       gpxfile.write(GPXFooterExtra)
@@ -1674,199 +3237,493 @@ def generateGPXreport(mapName, data, trackMode = True):
 def generateCSVreport(mapName, data):
     print "Generating CSV file %s.csv ..." % mapName
 
-    # Extract data log
-    readings = zip(*data[:6])
+    # Extract data log (dates in GMT+9 from Zulu time)
+    readings = data.rows("drive", lambda d: formatEpoch(d.time, JSTOffset, "-", " "), "lat", "lon", "cpm", "altitude")
     CSVHeader = """# drive id, datetime, CPM, latitude, longitude, altitude
 """
 
     csvfile = open(mapName+".csv", "w")
     csvfile.write(CSVHeader)
-    for did, dt, lat, lon, usv, alt in readings:
-       jpdate = datetime.strptime(dt, '%Y-%m-%dT%H:%M:%SZ') + timedelta(hours=+9) # GMT+9 from Zulu time
-       csvfile.write("%s,%s,%d,%.6f,%.6f,%.1f\n" % (did, jpdate.strftime("%Y-%m-%d %H:%M:%S"), int(usv*CPMfactor), lat, lon, alt))
+    for did, jpdate, lat, lon, usv, alt in readings:
+       csvfile.write("%s,%s,%d,%.6f,%.6f,%.1f\n" % (did, jpdate, int(usv*CPMfactor), lat, lon, alt))
     csvfile.close()
 
     print "Done."
     return mapName+".csv"
 
+# -----------------------------------------------------------------------------
+# Load all the drives from fileList (single pass per log)
+# -----------------------------------------------------------------------------
+def loadDrives(fileList, worldMode, ignoreDelay, ignoreDistance, tag, instantCPM):
+    for f in fileList:
+      try:
+        segments = loadLogSegments(f, True, worldMode, ignoreDelay, ignoreDistance, tag, instantCPM)
+      except:
+        # Generic trap if something crashed
+        logPrint('-'*60)
+        traceback.print_exc(file=sys.stdout)
+        logPrint('-'*60)
+        yield f, None
+        continue
+
+      for name, data in segments:
+        yield name, data
+
+# -----------------------------------------------------------------------------
+# Render the split area chunks, returns [(mapInfo, attachments), ...]
+# -----------------------------------------------------------------------------
+sharedChunks = [] # chunks inherited by the forked workers (not pickled)
+inWorker = False # already in a worker process (no nested workers)
+
+def workerCount(options):
+    jobs = getattr(options, "jobs", 1)
+    if jobs <= 0:
+      jobs = multiprocessing.cpu_count()
+    return jobs
+
+# -----------------------------------------------------------------------------
+# Map variants drawn from the same binning: name suffix, statistic, peak mode
+# -----------------------------------------------------------------------------
+mapVariants = {
+  "average": ("", "mean", False),
+  "peak60": ("_peak60", "max", True),
+  "peak5": ("_peak5", "peak5", True),
+}
+
+def optionMaps(options):
+    # --maps (comma separated list) or the single map selected by -m/-i
+    maps = getattr(options, "maps", None)
+    if isinstance(maps, basestring):
+      maps = [v.strip() for v in maps.split(",") if v.strip()]
+    if not maps:
+      if options.peak:
+        maps = [options.instant and "peak5" or "peak60"]
+      else:
+        maps = ["average"]
+    return maps
+
+def reportVariants(baseName, options):
+    # [(map name, statistic, peak mode)], the first name is used for the other reports
+    return [(baseName+mapVariants[v][0],)+mapVariants[v][1:] for v in optionMaps(options)]
+
+def renderChunk(chunkVariants, data, options):
+    chunkName = chunkVariants[0][0]
+    print "Processing %s" % chunkName
+    attachments = []
+    mapInfo = drawMap(chunkName, data, options.language, False, variants = chunkVariants)
+    if len(mapInfo) and options.pdf:
+      size, legend, statisticTable, skipped = mapInfo
+      for name, statistic, peak in chunkVariants:
+        attachments.append(generatePDFReport(name, options.language, size, legend, statisticTable))
+    return mapInfo, attachments
+
+def renderChunkWorker(connection, chunkVariants, index, options):
+    global inWorker
+    inWorker = True
+    try:
+      result = renderChunk(chunkVariants, sharedChunks[index], options)
+    except:
+      logPrint('-'*60)
+      traceback.print_exc(file=sys.stdout)
+      logPrint('-'*60)
+      result = None
+    sys.stdout.flush()
+    connection.send(result)
+    connection.close()
+
+def renderChunks(variants, chunks, options):
+    global sharedChunks
+    chunkVariants = [[(name+"_p%02d" % (i+1), statistic, peak) for name, statistic, peak in variants] for i in range(len(chunks))]
+
+    # Serial rendering in the log workers (they already run in parallel)
+    jobs = workerCount(options)
+    if inWorker or jobs < 2 or len(chunks) < 2 or not hasattr(os, "fork"):
+      return [renderChunk(v, c, options) for v, c in zip(chunkVariants, chunks)]
+
+    # The tiles of the chunk borders are decoded once, before the fork
+    areas = []
+    for chunk in chunks:
+      if len(chunk):
+        owidth, oheight, scale, parameters, area = mapScale(chunk.statistics())
+        areas.append(area+(parameters[0],))
+    shareTiles(areas)
+
+    sharedChunks = chunks
+    try:
+      results = runWorkers(renderChunkWorker, [(v, i, options) for i, v in enumerate(chunkVariants)], jobs)
+    finally:
+      sharedChunks = []
+    for v, result in zip(chunkVariants, results):
+      if result is None:
+        raise RuntimeError("Rendering of %s failed" % v[0][0])
+    return results
+
+# -----------------------------------------------------------------------------
+# Generate the reports of one drive, returns (report, status)
+# -----------------------------------------------------------------------------
+def processDrive(f, data, options):
+    language, charset, summary = options.language, options.charset, options.summary
+
+    global logfile
+    logfile = os.path.basename(f)
+    variants = reportVariants(os.path.splitext(f)[0], options)
+    logName = variants[0][0]
+
+    message = ""
+    if data is None:
+      # Log can't be loaded
+      return None, (f, -1)
+
+    try:
+      if not len(data):
+        print "No valid data available."
+
+        # Generate email report without attachments
+        skipped = data.skipped
+        message = generateHTMLReport(logName, language, [], skipped, charset)
+        return {"message": message, "attachments": []}, (logfile, sum([len(skipped[e]) for e in skipped.keys()]))
+
+      if summary:
+        # In summrary mode, don't generate separate reports
+        return None, None
+
+      # Draw map and generate reports
+      mapInfo, attachments = renderReports(variants, data, options)
+      if len(mapInfo) == 0:
+         # Wrong file, skip it
+         return None, None
+      size, legend, statisticTable, skipped = mapInfo
+
+      message = generateHTMLReport(logName, language, statisticTable, skipped, charset)
+      status = (f, sum([len(skipped[e]) for e in skipped.keys()]))
+    except:
+      # Generic trap if something crashed
+      logPrint('-'*60)
+      traceback.print_exc(file=sys.stdout)
+      logPrint('-'*60)
+      return None, (f, -1)
+
+    # Prepare attachment list
+    if message != "":
+      return {"message": message, "attachments": attachments}, status
+    return None, status
+
+# -----------------------------------------------------------------------------
+# Process one input log file, returns [(drive name, report, status, summary data), ...]
+# -----------------------------------------------------------------------------
+def processLog(f, options, tag):
+    results = []
+    for name, data in loadDrives([f], options.world, options.time, options.distance, tag, options.instant):
+      report, status = processDrive(name, data, options)
+      if options.summary and data is not None and len(data):
+        # Keep the readings for the summary report (only the dose if aggregated by the database)
+        if getattr(options, "dbSummary", False) and dbSupport:
+          data = data[:0]
+        results.append((name, report, status, data))
+      else:
+        results.append((name, report, status, None))
+    return results
+
+def processLogWorker(connection, f, options, tag):
+    global inWorker
+    inWorker = True
+    try:
+      results = processLog(f, options, tag)
+      closeDbWriter(False)
+    except:
+      logPrint('-'*60)
+      traceback.print_exc(file=sys.stdout)
+      logPrint('-'*60)
+      results = None
+    sys.stdout.flush()
+    connection.send(results)
+    connection.close()
+
+# -----------------------------------------------------------------------------
+# Run target(connection, *task) for each task in separate processes
+# -----------------------------------------------------------------------------
+def startWorker(target, args):
+    receiver, sender = multiprocessing.Pipe(False)
+    process = multiprocessing.Process(target=target, args=(sender,)+tuple(args))
+    process.start()
+    sender.close()
+    return process, receiver
+
+def finishedWorkers(running):
+    # running = [(key, name, process, receiver)], returns [(key, result)] of the ended workers
+    # (result is None for a worker that died without result)
+    finished = []
+    running[0][3].poll(0.1) # wait a little for the oldest one
+    for worker in running[:]:
+      key, name, process, receiver = worker
+      result = None
+      try:
+        if receiver.poll():
+          result = receiver.recv()
+        elif process.is_alive():
+          continue
+      except (EOFError, IOError):
+        print "Worker failed for %s (exit code %s)" % (name, process.exitcode)
+      process.join()
+      receiver.close()
+      running.remove(worker)
+      finished.append((key, result))
+    return finished
+
+def runWorkers(target, tasks, jobs):
+    # Results in the tasks order
+    results = [None]*len(tasks)
+    running = []
+    nextTask = 0
+    while nextTask < len(tasks) or running:
+      while nextTask < len(tasks) and len(running) < jobs:
+        process, receiver = startWorker(target, tasks[nextTask])
+        running.append((nextTask, tasks[nextTask][0], process, receiver))
+        nextTask += 1
+
+      for i, result in finishedWorkers(running):
+        results[i] = result
+    return results
+
+# -----------------------------------------------------------------------------
+# Run report stages [(name, dependencies, function)], returns {name: result}
+# -----------------------------------------------------------------------------
+def stageWorker(connection, function, results):
+    try:
+      result = (True, function(results))
+    except:
+      logPrint('-'*60)
+      traceback.print_exc(file=sys.stdout)
+      logPrint('-'*60)
+      result = (False, None)
+    sys.stdout.flush()
+    connection.send(result)
+    connection.close()
+
+def runStages(stages, jobs):
+    # function(results) gets the results of the previous stages, a stage starts
+    # (in a forked process) as soon as all its dependencies are done
+    results = {}
+    if jobs < 2 or inWorker or not hasattr(os, "fork"):
+      for name, dependencies, function in stages:
+        results[name] = function(results)
+      return results
+
+    failed = []
+    pending = list(stages)
+    running = []
+    while pending or running:
+      for stage in pending[:]:
+        name, dependencies, function = stage
+        if len(running) >= jobs:
+          break
+        if [d for d in dependencies if d in failed]:
+          failed.append(name)
+          pending.remove(stage)
+        elif not [d for d in dependencies if d not in results]:
+          process, receiver = startWorker(stageWorker, (function, results))
+          running.append((name, name, process, receiver))
+          pending.remove(stage)
+      if not running:
+        break # unknown dependencies
+
+      for name, result in finishedWorkers(running):
+        if result is not None and result[0]:
+          results[name] = result[1]
+        else:
+          failed.append(name)
+
+    if failed or pending:
+      raise RuntimeError("Report stages failed: %s" % ", ".join(failed + [s[0] for s in pending]))
+    return results
+
+# -----------------------------------------------------------------------------
+# Generate the map and the attachments of a dataset, returns (mapInfo, attachments)
+# -----------------------------------------------------------------------------
+def renderReports(variants, data, options):
+    # variants = reportVariants(), all the maps are drawn from one binning
+    language = options.language
+    logName = variants[0][0]
+
+    # KML, GPX, CSV and the maps are independent, the PDFs need the maps
+    def pdfStage(mapName):
+      def stage(results):
+        if len(results["map"]) == 0:
+          return None
+        size, legend, statisticTable, skipped = results["map"]
+        return generatePDFReport(mapName, language, size, legend, statisticTable)
+      return stage
+
+    # The database aggregates (DbReadings) have no individual readings to export
+    readings = isinstance(data, Drive)
+
+    stages = []
+    if options.kml and readings:
+      stages.append(("kml", [], lambda results: generateKMLreport(logName, data, useZipExtension = False)))
+    if options.gpx and readings:
+      stages.append(("gpx", [], lambda results: generateGPXreport(logName, data, trackMode = False)))
+    if options.csv and readings:
+      stages.append(("csv", [], lambda results: generateCSVreport(logName, data)))
+    stages.append(("map", [], lambda results: drawMap(logName, data, language, False, variants = variants)))
+    if options.pdf:
+      for mapName, statistic, peak in variants:
+        stages.append(("pdf "+mapName, ["map"], pdfStage(mapName)))
+    results = runStages(stages, workerCount(options))
+
+    # No PDF without a map
+    attachments = [results[name] for name, dependencies, function in stages if name != "map" and results[name] is not None]
+    mapInfo = results["map"]
+    if len(mapInfo) == 0:
+      # Wrong file, skip it
+      return mapInfo, attachments
+
+    # Generate extra 5km x 5km pages to report
+    if options.area and readings:
+      chunks = splitMapData(data, 5.0)
+      for chunkInfo, chunkAttachments in renderChunks(variants, chunks, options):
+        if len(chunkInfo) == 0:
+           # Wrong file, skip it
+           continue
+        mapInfo = chunkInfo
+        attachments += chunkAttachments
+
+    return mapInfo, attachments
+
 # -----------------------------------------------------------------------------
 # Process all input log files from fileList
 # -----------------------------------------------------------------------------
 @trace(debugMode)
 def processFiles(fileList, options):
-    language, charset, pdfEnabled, kmlEnabled, instantCPMEnabled, gpxEnabled, csvEnabled, worldMode, ignoreDelay, ignoreDistance, summary, splitArea, peak = (
-          options.language, options.charset, options.pdf, options.kml, options.instant,
-          options.gpx, options.csv, options.world, options.time, options.distance, options.summary, options.area, options.peak)
+    # The per log options are read by processLog
+    language, charset, worldMode, ignoreDelay, ignoreDistance, summary = (
+          options.language, options.charset, options.world, options.time, options.distance, options.summary)
 
-    global dbSupport
+    global dbSupport, dbWriter, dbBatchSize, summaryStoreEnabled
+    global logfile
 
+    configureLogCache(options)
+    configureTiles(options)
     tag = str(strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()))
-    logs = []
-
-    # Clean database
-    if dbSupport:
+    summaryDrives = []
+    summaryLogs = []
+
+    # Clean the readings of the previous run (one client shared by all the logs),
+    # the per cell summary is kept and updated by each log
+    dbBatchSize = getattr(options, "dbBatchSize", dbBatchSize)
+    summaryStoreEnabled = getattr(options, "summaryStore", summaryStoreEnabled)
+    writer = getDbWriter()
+    if writer is not None and writer.connection is not None:
       try:
-        connection = pymongo.Connection()
-        connection.drop_database("databot")
-        connection.disconnect()
+        writer.connection.databot.drop_collection("locations")
       except:
         dbSupport = False
+        dbWriter = None
+
+    # The summary aggregations need a recent server, otherwise merge in memory
+    if getattr(options, "dbSummary", False) and dbSupport and not dbAggregationSupport(getDbWriter().connection):
+      print "- MongoDB %d.%d or later needed by --db-summary, summary merged in memory" % dbAggregationVersion
+      options.dbSummary = False
+
+    # Write split drives only if requested (the logs are split in memory)
+    if getattr(options, "splitFiles", False):
+      for f in fileList:
+        splitLogFile(f, True, False, worldMode, ignoreDelay, ignoreDistance)
+
+    # Generate map and report (one worker process per log if jobs > 1)
+    jobs = workerCount(options)
+    tasks = [(f, options, tag) for f in fileList]
+    if jobs > 1 and len(tasks) > 1:
+      results = runWorkers(processLogWorker, tasks, jobs)
+    else:
+      results = [processLog(*t) for t in tasks]
 
-    # Split drives if necessary
-    newFiles = []
-    for f in fileList:
-      newFile = splitLogFile(f, True, False, worldMode, ignoreDelay, ignoreDistance)
-      newFiles += newFile
-
-    # Generate map and report
     reports = {}
     processStatus = []
-    fileList += newFiles
-    for f in fileList:
-      global logfile
-      logfile = os.path.basename(f)
-      logName = os.path.splitext(f)[0]
+    for f, result in zip(fileList, results):
+      if result is None:
+        # Worker crashed
+        processStatus.append((f, -1))
+        continue
 
-      logs.append({'log': logfile})
+      for name, report, status, data in result:
+        if status is not None:
+          processStatus.append(status)
+        if report is not None:
+          reports[name] = report
+        if data is not None:
+          summaryDrives.append(data)
+          summaryLogs.append({"log": os.path.basename(name)})
 
-      if peak:
-        if instantCPMEnabled:
-          logName+="_peak5"
-        else:
-          logName+="_peak60"
+    # Build the database indexes once for all the logs
+    try:
+      closeDbWriter()
+    except:
+      logPrint('-'*60)
+      traceback.print_exc(file=sys.stdout)
+      logPrint('-'*60)
+
+    # Summary report (the datasets of all the logs merged in memory or aggregated by the database)
+    if summary:
+      logfile = "SUMMARY.LOG"
+      variants = reportVariants(os.path.splitext(logfile)[0], options)
+      logName = variants[0][0]
 
       attachments = []
       message = ""
-      try:
-        # Load data log
-        data = loadLogFile(f, True, worldMode, ignoreDelay, ignoreDistance, tag, instantCPMEnabled)
-        if not len(data[0]):
+      while True:
+        # Merge data logs
+        if getattr(options, "dbSummary", False) and dbSupport:
+          data = DbReadings(summaryLogs, dose = sum([d.dose for d in summaryDrives]))
+        else:
+          data = concatenateDrives(summaryDrives, sum([len(d) for d in summaryDrives]), sum([d.dose for d in summaryDrives]))
+        del summaryDrives[:]
+        if not len(data):
           print "No valid data available."
+          break
 
-          # Generate email report without attachments
-          skipped = data[7]
-          message = generateHTMLReport(logName, language, [], skipped, charset)
-          reports[f] = {"message": message, "attachments": []}
-          processStatus.append((logfile, sum([len(skipped[e]) for e in skipped.keys()])))
-          continue
-
-        if summary:
-          # In summrary mode, don't generate separate reports
-          continue
-
-        if kmlEnabled:
-          attachments.append(generateKMLreport(logName, data, useZipExtension = False))
-        if gpxEnabled:
-          attachments.append(generateGPXreport(logName, data, trackMode = False))
-        if csvEnabled:
-          attachments.append(generateCSVreport(logName, data))
-
-        # Draw map
-        mapInfo = drawMap(logName, data, language, False, peak = peak)
+        # Draw map and generate reports
+        mapInfo, attachments = renderReports(variants, data, options)
         if len(mapInfo) == 0:
            # Wrong file, skip it
-           continue
+           break
         size, legend, statisticTable, skipped = mapInfo
 
-        # Generate reports
-        if pdfEnabled:
-          attachments.append(generatePDFReport(logName, language, size, legend, statisticTable))
-
-        # Generate extra 5km x 5km pages to report
-        if splitArea:
-          chunks = splitMapData(data, 5.0)
-          chunkCounter = 1
-
-          for c in chunks:
-            chunkName = logName+"_p%02d" % chunkCounter
-            chunkCounter+=1
-            print "Processing %s" % chunkName
-            mapInfo = drawMap(chunkName, c, language, False, peak = peak)
-            if len(mapInfo) == 0:
-               # Wrong file, skip it
-               continue
-            size, legend, statisticTable, skipped = mapInfo
-
-            # Generate reports
-            if pdfEnabled:
-              attachments.append(generatePDFReport(chunkName, language, size, legend, statisticTable))
-
         message = generateHTMLReport(logName, language, statisticTable, skipped, charset)
-        processStatus.append((f, sum([len(skipped[e]) for e in skipped.keys()])))
-      except:
-        # Generic trap if something crashed
-        logPrint('-'*60)
-        traceback.print_exc(file=sys.stdout)
-        logPrint('-'*60)
-        processStatus.append((f, -1))
-        continue
+        processStatus.append((logfile, sum([len(skipped[e]) for e in skipped.keys()])))
+        break
+
+      if isinstance(data, DbReadings):
+        data.close()
 
       # Prepare attachment list
       if message != "":
-         reports[f] = {"message": message, "attachments": attachments}
-
-    # Summary report
-    if dbSupport and summary:
-      logfile = "SUMMARY.LOG"
-      logName = os.path.splitext(logfile)[0]
+         reports[logfile] = {"message": message, "attachments": attachments}
 
-      if peak:
-        if instantCPMEnabled:
-          logName+="_peak5"
-        else:
-          logName+="_peak60"
+    # Global summary report (all the logs ever processed, from the per cell summary)
+    if getattr(options, "globalSummary", False):
+      logfile = "GLOBAL_SUMMARY.LOG"
+      variants = reportVariants(os.path.splitext(logfile)[0], options)
+      logName = variants[0][0]
 
       attachments = []
       message = ""
+      store = getSummaryStore()
       while True:
-        # Load data log
-        data = loadDbData("", True, logs)
-        if not len(data[0]):
-          print "No valid data available."
+        if store is None or not len(store):
+          print "No summary data available."
           break
 
-        if kmlEnabled:
-          attachments.append(generateKMLreport(logName, data, useZipExtension = False))
-        if gpxEnabled:
-          attachments.append(generateGPXreport(logName, data, trackMode = False))
-        if csvEnabled:
-          attachments.append(generateCSVreport(logName, data))
-
-        # Draw map
-        mapInfo = drawMap(logName, data, language, False, peak = peak)
+        # Draw map and generate reports
+        mapInfo, attachments = renderReports(variants, store, options)
         if len(mapInfo) == 0:
-           # Wrong file, skip it
            break
         size, legend, statisticTable, skipped = mapInfo
 
-        # Generate reports
-        if pdfEnabled:
-          attachments.append(generatePDFReport(logName, language, size, legend, statisticTable))
-
-        # Generate extra 5km x 5km pages to report
-        if splitArea:
-          chunks = splitMapData(data, 5.0)
-          chunkCounter = 1
-
-          for c in chunks:
-            chunkName = logName+"_p%02d" % chunkCounter
-            chunkCounter+=1
-            print "Processing %s" % chunkName
-            mapInfo = drawMap(chunkName, c, language, False, peak = peak)
-            if len(mapInfo) == 0:
-               # Wrong file, skip it
-               continue
-            size, legend, statisticTable, skipped = mapInfo
-
-            # Generate reports
-            if pdfEnabled:
-              attachments.append(generatePDFReport(chunkName, language, size, legend, statisticTable))
-
         message = generateHTMLReport(logName, language, statisticTable, skipped, charset)
-        processStatus.append((logfile, sum([len(skipped[e]) for e in skipped.keys()])))
+        processStatus.append((logfile, 0))
         break
+      closeDbWriter(False)
 
-      # Prepare attachment list
       if message != "":
          reports[logfile] = {"message": message, "attachments": attachments}
 
@@ -1922,11 +3779,102 @@ if __name__ == '__main__':
     parser.add_option("-m", "--max",
                       action="store_true", dest="peak", default=False,
                       help="keep peak measurement per block")
+    parser.add_option("-M", "--maps",
+                      type=str, dest="maps", default=None,
+                      help="draw several maps from one binning, comma separated list of %s" % ", ".join(sorted(mapVariants.keys())))
+    parser.add_option("-S", "--split-files",
+                      action="store_true", dest="splitFiles", default=False,
+                      help="write each drive of the log to a _NNN.LOG file")
+    parser.add_option("-F", "--fix-checksums",
+                      action="store_true", dest="fixChecksums", default=False,
+                      help="only repair the wrong checksums of the logs (in place)")
+    parser.add_option("-j", "--jobs",
+                      type=int, dest="jobs", default=1,
+                      help="number of logs processed in parallel (default 1, 0 = all the cores)")
+    parser.add_option("--db-batch-size",
+                      type=int, dest="dbBatchSize", default=dbBatchSize,
+                      help="number of readings per database bulk insert (default %d)" % dbBatchSize)
+    parser.add_option("--db-summary",
+                      action="store_true", dest="dbSummary", default=False,
+                      help="aggregate the summary map in the database (large areas, no KML/GPX/CSV, MongoDB 3.2)")
+    parser.add_option("--no-summary-store",
+                      action="store_false", dest="summaryStore", default=True,
+                      help="don't add the logs to the persistent per cell summary")
+    parser.add_option("-G", "--global-summary",
+                      action="store_true", dest="globalSummary", default=False,
+                      help="generate the summary report of all the logs ever processed")
+    parser.add_option("--tile-source",
+                      type=str, dest="tileSource", default=tileSource,
+                      help="specify the tile server URL template, MBTiles file or tile folder (default %s)" % tileSource)
+    parser.add_option("--tile-url",
+                      type=str, dest="tileSource",
+                      help="deprecated, same as --tile-source")
+    parser.add_option("--tile-jobs",
+                      type=int, dest="tileJobs", default=tileWorkers,
+                      help="number of tiles downloaded in parallel (default %d)" % tileWorkers)
+    parser.add_option("--tile-cache",
+                      type=str, dest="tileCache", default=tileCacheFile,
+                      help="specify the tile cache file (default %s)" % tileCacheFile)
+    parser.add_option("--tile-cache-size",
+                      type=float, dest="tileCacheSize", default=tileCacheMaxSize/1048576.0,
+                      help="specify the tile cache size in MB (default %d)" % (tileCacheMaxSize/1048576))
+    parser.add_option("--prewarm-tiles",
+                      type=str, dest="prewarmTiles", default=None,
+                      help="only fill the tile cache for a zoom range (for example 11-15)")
+    parser.add_option("--prewarm-area",
+                      type=str, dest="prewarmArea", default="%g,%g,%g,%g" % (JP_lat_min, JP_lon_min, JP_lat_max, JP_lon_max),
+                      help="specify the area of --prewarm-tiles as lat_min,lon_min,lat_max,lon_max (default Japan)")
+    parser.add_option("-n", "--no-cache",
+                      action="store_false", dest="cache", default=True,
+                      help="don't use the parsed log cache")
+    parser.add_option("--cache-folder",
+                      type=str, dest="cacheFolder", default=logCacheFolder,
+                      help="specify the parsed log cache folder (default %s)" % logCacheFolder)
+    parser.add_option("--cache-size",
+                      type=float, dest="cacheSize", default=logCacheMaxSize/1048576.0,
+                      help="specify the parsed log cache size in MB (default %d)" % (logCacheMaxSize/1048576))
+    parser.add_option("--cache-list",
+                      action="store_true", dest="cacheList", default=False,
+                      help="list the parsed log cache entries")
+    parser.add_option("--cache-purge",
+                      action="store_true", dest="cachePurge", default=False,
+                      help="remove all the parsed log cache entries")
 
     (options, args) = parser.parse_args()
 
-    if len(args) != 1:
+    for v in optionMaps(options):
+      if v not in mapVariants:
+        parser.error("Unknown map %s" % v)
+
+    configureLogCache(options)
+    if options.cacheList or options.cachePurge:
+      if options.cachePurge:
+        purgeLogCache()
+      if options.cacheList:
+        listLogCache()
+      sys.exit(0)
+
+    if options.prewarmTiles:
+      try:
+        zooms = [int(z) for z in options.prewarmTiles.split("-")]
+        area = [float(v) for v in options.prewarmArea.split(",")]
+      except ValueError:
+        parser.error("Wrong --prewarm-tiles or --prewarm-area")
+      if len(area) != 4 or not 1 <= len(zooms) <= 2 or not 0 <= zooms[0] <= zooms[-1] <= 17:
+        parser.error("Wrong --prewarm-tiles or --prewarm-area")
+      configureTiles(options)
+      if not prewarmTiles(area[0], area[1], area[2], area[3], zooms[0], zooms[-1]):
+        sys.exit(1)
+      sys.exit(0)
+
+    if len(args) != 1 and not (options.globalSummary and len(args) == 0):
         parser.error("Wrong number of arguments")
 
-    files = glob.glob(args[0])
-    processFiles(files, options)
+    files = []
+    if args:
+      files = glob.glob(args[0])
+    if options.fixChecksums:
+      for f in files:
+        fixLogChecksums(f)
+    else:
+      processFiles(files, options)
@@ -136,6 +136,12 @@ class Gmail():
      options.instant = False
      options.area = False
      options.peak = False
+     options.splitFiles = False
+     options.cache = True
+     options.jobs = 0 # all the cores
+     options.dbSummary = False
+     options.summaryStore = True
+     options.maps = None
      report = 0
      for emailid in items:
          logPrint("[GMAIL] Processing email id %s" % emailid)
@@ -198,6 +204,13 @@ class Gmail():
            options.instant = True
            options.peak = True
 
+         # Several maps requested, drawn from one parse and one binning
+         maps = [v for v in ["average", "peak60", "peak5"] if mail["Subject"].upper().find("[%s]" % v.upper()) != -1]
+         if len(maps) > 1:
+           options.maps = maps
+           options.instant = False
+           options.peak = False
+
          # If no special type requested, set to default
          if not report:
            options.pdf = True
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# In-process MongoDB collections with the subset of the pymongo API used by
+# bgeigie_report (ReadingWriter, SummaryStore, DbReadings), calls recorded for
+# the tests
+import copy, math
+
+def matches(document, query):
+    for key, value in query.items():
+      if isinstance(value, dict) and "$in" in value:
+        if document.get(key) not in value["$in"]:
+          return False
+      elif isinstance(value, dict) and "$lte" in value:
+        if key not in document or document[key] > value["$lte"]:
+          return False
+      elif document.get(key) != value:
+        return False
+    return True
+
+def evaluate(expression, document, variables = {}):
+    # Aggregation expression (operators used by DbReadings only)
+    if isinstance(expression, basestring) and expression.startswith("$$"):
+      return variables[expression[2:]]
+    if isinstance(expression, basestring) and expression.startswith("$"):
+      return document[expression[1:]]
+    if isinstance(expression, list):
+      return [evaluate(e, document, variables) for e in expression]
+    if not isinstance(expression, dict):
+      return expression
+    if not expression.keys()[0].startswith("$"):
+      return dict([(name, evaluate(e, document, variables)) for name, e in expression.items()])
+    (operator, arguments), = expression.items()
+    if operator == "$let":
+      scope = dict(variables)
+      for name, value in arguments["vars"].items():
+        scope[name] = evaluate(value, document, variables)
+      return evaluate(arguments["in"], document, scope)
+    if operator == "$cond":
+      # Only the selected branch is evaluated
+      condition, whenTrue, whenFalse = arguments
+      return evaluate(evaluate(condition, document, variables) and whenTrue or whenFalse, document, variables)
+    values = evaluate(arguments, document, variables)
+    if operator == "$floor":
+      return math.floor(values)
+    if operator == "$divide":
+      return values[0]/values[1]
+    if operator == "$subtract":
+      return values[0]-values[1]
+    if operator == "$add":
+      return sum(values)
+    if operator == "$lt":
+      return values[0] < values[1]
+    if operator == "$gte":
+      return values[0] >= values[1]
+    if operator == "$arrayElemAt":
+      return values[0][int(values[1])]
+    raise ValueError("Unsupported operator %s" % operator)
+
+def group(documents, specification):
+    groups = {}
+    for document in documents:
+      key = evaluate(specification["_id"], document)
+      groups.setdefault(repr(key), (key, []))[1].append(document)
+    result = []
+    for key, members in groups.values():
+      output = {"_id": key}
+      for name, accumulator in specification.items():
+        if name == "_id":
+          continue
+        (operator, expression), = accumulator.items()
+        values = [evaluate(expression, d) for d in members]
+        if operator == "$sum":
+          output[name] = sum(values)
+        elif operator == "$min":
+          output[name] = min(values)
+        elif operator == "$max":
+          output[name] = max(values)
+        elif operator == "$avg":
+          output[name] = sum(values)/float(len(values))
+      result.append(output)
+    return result
+
+class Cursor(list):
+    def batch_size(self, size):
+      return self
+
+class BulkOperation:
+    def __init__(self, collection, query):
+      self.collection = collection
+      self.query = query
+      self.upserted = False
+
+    def upsert(self):
+      self.upserted = True
+      return self
+
+    def update(self, changes):
+      self.collection.pending.append((self.query, changes, self.upserted))
+
+class Bulk:
+    def __init__(self, collection):
+      self.collection = collection
+      collection.pending = []
+
+    def find(self, query):
+      return BulkOperation(self.collection, query)
+
+    def execute(self):
+      self.collection.calls.append(("bulk", len(self.collection.pending)))
+      for query, changes, upserted in self.collection.pending:
+        self.collection.apply(query, changes, upserted)
+      self.collection.pending = []
+
+class Collection:
+    def __init__(self):
+      self.documents = []
+      self.indexes = []
+      self.calls = []
+      self.pending = []
+
+    def insert(self, documents):
+      self.calls.append(("insert", len(documents)))
+      for document in documents:
+        document = copy.deepcopy(document)
+        document.setdefault("_id", len(self.documents))
+        self.documents.append(document)
+
+    def create_index(self, keys, **options):
+      self.indexes.append(keys)
+
+    def find(self, query = {}, fields = None):
+      result = Cursor()
+      for document in self.documents:
+        if matches(document, query):
+          document = copy.deepcopy(document)
+          if fields:
+            document = dict([(k, v) for k, v in document.items() if fields.get(k, k == "_id")])
+          result.append(document)
+      return result
+
+    def find_one(self, query):
+      result = self.find(query)
+      return result and result[0] or None
+
+    def save(self, document):
+      self.remove({"_id": document["_id"]})
+      self.documents.append(copy.deepcopy(document))
+
+    def remove(self, query):
+      self.documents = [d for d in self.documents if not matches(d, query)]
+
+    def update(self, query, changes, upsert = False):
+      self.calls.append(("update", 1))
+      self.apply(query, changes, upsert)
+
+    def apply(self, query, changes, upsert):
+      found = [d for d in self.documents if matches(d, query)]
+      if not found:
+        if not upsert:
+          return
+        found = [dict(query)]
+        self.documents.append(found[0])
+      document = found[0]
+      for key, value in changes.get("$inc", {}).items():
+        document[key] = document.get(key, 0) + value
+      for key, value in changes.get("$max", {}).items():
+        document[key] = max(document.get(key, value), value)
+      for key, value in changes.get("$set", {}).items():
+        document[key] = value
+
+    def aggregate(self, pipeline):
+      # pymongo >= 3 result (iterable of documents)
+      self.calls.append(("aggregate", len(pipeline)))
+      documents = self.documents
+      for stage in pipeline:
+        (operator, specification), = stage.items()
+        if operator == "$match":
+          documents = [d for d in documents if matches(d, specification)]
+        elif operator == "$project":
+          documents = [dict([(name, evaluate(e is True and "$"+name or e, d)) for name, e in specification.items()]) for d in documents]
+        elif operator == "$group":
+          documents = group(documents, specification)
+      return iter(documents)
+
+    def initialize_unordered_bulk_op(self):
+      return Bulk(self)
+
+class Database:
+    def __init__(self):
+      self.collections = {}
+
+    def __getattr__(self, name):
+      if name.startswith("__"):
+        raise AttributeError(name)
+      return self.collections.setdefault(name, Collection())
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+# Binning aggregated by the database (DbReadings) against the in-memory
+# binning (rectangularBinNumpy) of the same readings
+import os, sys, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bgeigie_report as br
+import fake_mongo
+
+samplesFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples")
+sampleLogs = ["102-0329.LOG", "103-0307.LOG", "103-0314.LOG"]
+
+class Mercator:
+    # Spherical Mercator with the Basemap call convention
+    radius = 6378137.0
+
+    def __call__(self, x, y, inverse = False):
+      x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+      if inverse:
+        return np.degrees(x/self.radius), np.degrees(2*np.arctan(np.exp(y/self.radius))-np.pi/2)
+      return self.radius*np.radians(x), self.radius*np.log(np.tan(np.pi/4+np.radians(y)/2))
+
+@unittest.skipIf(not br.dbSupport, "pymongo not installed")
+class DbReadingsTest(unittest.TestCase):
+    def setUp(self):
+      br.logCacheEnabled = False
+      br.summaryStoreEnabled = False
+      self.collection = fake_mongo.Collection()
+      writer = br.ReadingWriter(self.collection, batchSize = 1000)
+      drives, logs = [], []
+      for name in sampleLogs:
+        for drive in br.parseLogDrives(os.path.join(samplesFolder, name), True, False, False, False, False, False, False):
+          writer.write(drive, "tag", name)
+          drives.append(drive)
+        logs.append({"log": name})
+      writer.close()
+      self.data = br.concatenateDrives(drives, sum([len(d) for d in drives]))
+      self.readings = br.DbReadings(logs, self.collection)
+      self.m = Mercator()
+
+    def tearDown(self):
+      br.summaryStoreEnabled = True
+
+    def testStatistics(self):
+      expected, result = self.data.statistics(), self.readings.statistics()
+      self.assertEqual(sorted(result.keys()), sorted(expected.keys()))
+      for key in expected:
+        self.assertAlmostEqual(float(result[key]), float(expected[key]), 6, key)
+
+    def testBinning(self):
+      # Same cells, counts, means and peaks for coarse and fine grids
+      x, y = self.m(self.data.lon, self.data.lat)
+      x_min, y_min, x_max, y_max = x.min()-500.0, y.min()-500.0, x.max()+500.0, y.max()+500.0
+      for xbins, ybins in [(5, 5), (40, 30), (120, 80)]:
+        cells, stats, extent, centers = br.rectangularBinNumpy(x_min, y_min, x_max, y_max, (x, y, self.data.cpm), xbins, ybins)
+        dbCells, dbStats, dbExtent, dbCenters = self.readings.binning(self.m, x_min, y_min, x_max, y_max, xbins, ybins)
+        self.assertTrue(np.array_equal(dbCells, cells), (xbins, ybins))
+        self.assertEqual(dbStats["count"].sum(), len(self.data))
+        for statistic in ["count", "mean", "max"]:
+          self.assertTrue(np.allclose(dbStats[statistic], stats[statistic], rtol=1e-9, atol=0.0), (xbins, ybins, statistic))
+        self.assertEqual(dbExtent, extent)
+        self.assertTrue(np.array_equal(dbCenters, centers))
+        for peak in [False, True]:
+          statistic = peak and "max" or "mean"
+          expected = br.rectangularBinRaster(*br.rectangularBinSelect(cells, stats, centers, statistic, peak)[:2] + (xbins, ybins))
+          result = br.rectangularBinRaster(*br.rectangularBinSelect(dbCells, dbStats, dbCenters, statistic, peak)[:2] + (xbins, ybins))
+          self.assertTrue(np.array_equal(np.ma.getmaskarray(result), np.ma.getmaskarray(expected)))
+          self.assertTrue(np.allclose(result.filled(0.0), expected.filled(0.0), rtol=1e-9, atol=0.0))
+
+if __name__ == "__main__":
+    unittest.main()
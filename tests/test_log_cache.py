@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Parsed log cache: entries read back as parsed, least recently used entries
+# removed past logCacheMaxSize
+import os, sys, shutil, tempfile, unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bgeigie_report as br
+
+samplesFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples")
+
+class LogCacheTest(unittest.TestCase):
+    def setUp(self):
+      self.saved = br.logCacheEnabled, br.logCacheFolder, br.logCacheMaxSize
+      br.logCacheFolder = tempfile.mkdtemp()
+      br.logCacheMaxSize = 256*1024*1024
+      self.drives = br.parseLogDrives(os.path.join(samplesFolder, "103-0314.LOG"), True, False, False, False, False, False, False)
+
+    def tearDown(self):
+      shutil.rmtree(br.logCacheFolder)
+      br.logCacheEnabled, br.logCacheFolder, br.logCacheMaxSize = self.saved
+
+    def keys(self):
+      return sorted([os.path.basename(path)[:-4] for last, size, path in br.logCacheEntries()])
+
+    def save(self, key, last):
+      br.saveLogCache(key, self.drives)
+      os.utime(os.path.join(br.logCacheFolder, key+".npz"), (last, last))
+
+    def testRoundTrip(self):
+      br.saveLogCache("log", self.drives)
+      drives = br.loadLogCache("log")
+      self.assertEqual(len(drives), len(self.drives))
+      for drive, expected in zip(drives, self.drives):
+        self.assertTrue(np.array_equal(drive.readings, expected.readings))
+        self.assertEqual((drive.dose, drive.skipped, drive.model), (expected.dose, expected.skipped, expected.model))
+      self.assertEqual(br.loadLogCache("missing"), None)
+
+    def testLeastRecentlyUsed(self):
+      # Loading an entry makes it the most recently used
+      self.save("a", 1000)
+      self.save("b", 2000)
+      self.save("c", 3000)
+      size = br.logCacheEntries()[0][1]
+      br.logCacheMaxSize = 3*size
+      self.assertNotEqual(br.loadLogCache("a"), None)
+      self.save("d", 4000)
+      self.assertEqual(self.keys(), ["a", "c", "d"])
+      br.logCacheMaxSize = 2*size
+      self.save("e", 5000)
+      self.assertEqual(self.keys(), ["a", "e"])
+      self.assertTrue(sum([e[1] for e in br.logCacheEntries()]) <= br.logCacheMaxSize)
+
+    def testInvalidEntry(self):
+      # A corrupted entry is removed and the log parsed again
+      with open(os.path.join(br.logCacheFolder, "bad.npz"), "wb") as f:
+        f.write("not a npz file")
+      self.assertEqual(br.loadLogCache("bad"), None)
+      self.assertEqual(self.keys(), [])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+# Regression test of the columnar log parser (LogParser) against the original
+# line by line parser and splitLogFile logic
+import os, sys, shutil, tempfile, unittest, calendar, operator
+from datetime import datetime, timedelta
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bgeigie_report as br
+
+samplesFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples")
+sampleLogs = ["102-0329.LOG", "103-0307.LOG", "103-0314.LOG"]
+
+# -----------------------------------------------------------------------------
+# Original implementation (line by line)
+# -----------------------------------------------------------------------------
+def checksum(line):
+    return reduce(operator.xor, map(ord, line[1:]))
+
+def referenceSplit(lines, timeSplit, distanceSplit, worldMode, ignoreDelay, ignoreDistance):
+  # Same split decisions as the original splitLogFile, one list of lines per drive
+  pieces = [[]]
+  dlasttime = 0
+  blastlat = 0
+  blastlon = 0
+  for line in lines:
+    if line[0] == "#":
+      pieces[-1].append(line)
+      continue
+    data = line.split(",")[:br.maxDataColumns]
+    if data[0] not in ("$BMRDD", "$BGRDD", "$BNRDD") or len(data) != br.maxDataColumns or data[6] != "A":
+      pieces[-1].append(line)
+      continue
+    try:
+      dtime = datetime.strptime(data[2], '%Y-%m-%dT%H:%M:%SZ')
+      if dlasttime != 0 and timeSplit and not ignoreDelay:
+        delta = br.seconds_difference(dtime, dlasttime)
+        if delta > br.maxDelayBetweenReadings or delta < -br.maxDelayBetweenReadings:
+          pieces.append([])
+          blastlat = 0
+          blastlon = 0
+      dlasttime = dtime
+      blat = abs(float(data[7]))/100
+      blon = abs(float(data[9]))/100
+      blon = ((blon-int(blon))/60)*100+int(blon)
+      blat = ((blat-int(blat))/60)*100+int(blat)
+      if "S" == data[8]: blat = -blat
+      if "W" == data[10]: blon = -blon
+      if not worldMode:
+        if (blat < br.JP_lat_min) or (blat > br.JP_lat_max) or (blon < br.JP_lon_min) or (blon > br.JP_lon_max):
+          pieces[-1].append(line)
+          continue
+      if (blastlon != 0) and (blastlat != 0) and distanceSplit and not ignoreDistance:
+        if br.distance_on_unit_sphere(blastlat, blastlon, blat, blon) > br.maxDistanceBetweenReadings:
+          pieces.append([])
+          dlasttime = 0
+      blastlat = blat
+      blastlon = blon
+    except:
+      pass
+    pieces[-1].append(line)
+  return pieces
+
+def referenceLoad(lines, enableuSv, worldMode, ignoreDelay, ignoreDistance, instantCPM):
+  # Same readings as the original loadLogFile (without the database)
+  result = {"drive": [], "time": [], "lat": [], "lon": [], "cpm": [], "altitude": []}
+  skipped = {"U": [], "H": [], "T": [], "D": [], "O": []}
+  totalDose = 0
+  dlasttime = 0
+  blastlon = 0
+  blastlat = 0
+  lineCounter = 0
+  for line in lines:
+    lineCounter += 1
+    if line[0] == "#":
+      continue
+    data = line.split(",")
+    try:
+      int(line.split("*")[1][:2],16)
+    except:
+      skipped["H"].append(lineCounter)
+      continue
+    data = data[:br.maxDataColumns]
+    if data[0] not in ("$BMRDD", "$BGRDD", "$BNRDD") or len(data) != br.maxDataColumns or data[6] != "A" or data[12] != "A":
+      skipped["H"].append(lineCounter)
+      continue
+    try:
+      dtime = datetime.strptime(data[2], '%Y-%m-%dT%H:%M:%SZ')
+      if dlasttime != 0 and not ignoreDelay:
+        delta = br.seconds_difference(dtime, dlasttime)
+        if delta > br.maxDelayBetweenReadings or delta < -br.maxDelayBetweenReadings:
+          skipped["T"].append(lineCounter)
+          continue
+      dlasttime = dtime
+      if instantCPM:
+        bcpm = float(data[4])*12
+      else:
+        bcpm = float(data[3])
+      if enableuSv: bcpm /= br.CPMfactor
+      totalDose += float(data[4])
+      baltitude = float(data[11])
+      blat = abs(float(data[7]))/100
+      blon = abs(float(data[9]))/100
+      blon = ((blon-int(blon))/60)*100+int(blon)
+      blat = ((blat-int(blat))/60)*100+int(blat)
+      if "S" == data[8]: blat = -blat
+      if "W" == data[10]: blon = -blon
+      if (((blat == 0) and (blon == 0)) or
+          ((blat < -90.0) or (blat > 90.0) or (blon < -180) or (blon > 180))):
+        skipped["U"].append(lineCounter)
+        continue
+      if not worldMode:
+        if (blat < br.JP_lat_min) or (blat > br.JP_lat_max) or (blon < br.JP_lon_min) or (blon > br.JP_lon_max):
+          skipped["O"].append(lineCounter)
+          continue
+      if (blastlon != 0) and (blastlat != 0) and not ignoreDistance:
+        if br.distance_on_unit_sphere(blastlat, blastlon, blat, blon) > br.maxDistanceBetweenReadings:
+          skipped["D"].append(lineCounter)
+          continue
+      blastlat = blat
+      blastlon = blon
+    except:
+      skipped["U"].append(lineCounter)
+      continue
+    if (baltitude < 0):
+      baltitude = 0
+    elif (baltitude > br.JP_alt_max) and not worldMode:
+      baltitude = br.JP_alt_max
+    result["drive"].append(data[1])
+    result["time"].append(calendar.timegm(dtime.timetuple()))
+    result["lat"].append(blat)
+    result["lon"].append(blon)
+    result["cpm"].append(bcpm)
+    result["altitude"].append(baltitude)
+  if enableuSv: totalDose /= br.CPMfactor
+  return result, totalDose, skipped
+
+# -----------------------------------------------------------------------------
+# Log with all the issues handled by the parser
+# -----------------------------------------------------------------------------
+def rewrite(line, **fields):
+    # Change some columns of a reading and recompute its checksum
+    columns = {"time": 2, "cpm": 3, "lat": 7, "lon": 9}
+    data = line.split("*")[0].split(",")
+    for name, value in fields.items():
+      data[columns[name]] = value
+    body = ",".join(data)
+    return "%s*%02X\n" % (body, checksum(body))
+
+def shiftTime(line, hours):
+    t = datetime.strptime(line.split(",")[2], '%Y-%m-%dT%H:%M:%SZ') + timedelta(hours=hours)
+    return rewrite(line, time=t.strftime('%Y-%m-%dT%H:%M:%SZ'))
+
+def shiftLatitude(line, minutes):
+    return rewrite(line, lat="%.4f" % (float(line.split(",")[7])+minutes))
+
+def faultyLog(lines):
+    lines = list(lines)
+    n = len(lines)
+    lines.insert(0, "# NEW LOG\n")
+    lines.insert(1, "# format=1.0.0\n")
+    # Wrong checksum (reading kept with a warning)
+    lines[10] = lines[10].split("*")[0] + "*00\n"
+    # Header issues
+    lines[20] = lines[20].replace("$BMRDD", "$BXRDD")
+    lines[21] = lines[21].split("*")[0] + "\n"
+    lines[22] = lines[22].replace(",A,", ",V,", 1)
+    lines[23] = "garbage\n"
+    # Outside Japan
+    lines[30] = rewrite(lines[30], lat="5000.0000")
+    lines[31] = rewrite(lines[31], lon="12000.0000")
+    # Delay (second drive)
+    for i in range(n/3, n+2):
+      lines[i] = shiftTime(lines[i], 3)
+    # Distance (third drive if split on distance)
+    for i in range(2*n/3, n+2):
+      lines[i] = shiftLatitude(lines[i], 60)
+    return lines
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+class LogParserTest(unittest.TestCase):
+    configurations = [
+      # enableuSv, worldMode, ignoreDelay, ignoreDistance, instantCPM, timeSplit, distanceSplit
+      (True, False, False, False, False, True, False),
+      (True, True, False, False, True, True, True),
+      (False, False, False, True, False, True, True),
+      (True, False, True, False, False, True, True),
+      (True, False, False, False, False, False, False),
+    ]
+
+    def setUp(self):
+      self.folder = tempfile.mkdtemp()
+      self.logs = []
+      for name in sampleLogs:
+        with open(os.path.join(samplesFolder, name)) as f:
+          lines = f.readlines()
+        path = os.path.join(self.folder, name)
+        with open(path, "w") as f:
+          f.writelines(lines)
+        self.logs.append((path, lines))
+        path = os.path.join(self.folder, "faulty-" + name)
+        lines = faultyLog(lines)
+        with open(path, "w") as f:
+          f.writelines(lines)
+        self.logs.append((path, lines))
+
+    def tearDown(self):
+      shutil.rmtree(self.folder)
+
+    def compare(self, path, lines, configuration):
+      enableuSv, worldMode, ignoreDelay, ignoreDistance, instantCPM, timeSplit, distanceSplit = configuration
+      expected = [referenceLoad(piece, enableuSv, worldMode, ignoreDelay, ignoreDistance, instantCPM)
+                  for piece in referenceSplit(lines, timeSplit, distanceSplit, worldMode, ignoreDelay, ignoreDistance)]
+      drives = br.parseLogDrives(path, enableuSv, worldMode, ignoreDelay, ignoreDistance, instantCPM, timeSplit, distanceSplit)
+      message = "%s %r" % (os.path.basename(path), configuration)
+      self.assertEqual(len(drives), len(expected), message)
+      for drive, (result, dose, skipped) in zip(drives, expected):
+        self.assertEqual(drive.drive.tolist(), result["drive"], message)
+        for column in ("time", "lat", "lon", "cpm", "altitude"):
+          np.testing.assert_array_equal(getattr(drive, column), np.array(result[column]), message + " " + column)
+        self.assertAlmostEqual(drive.dose, dose, 9, message)
+        self.assertEqual(dict([(k, len(v)) for k, v in drive.skipped.items()]),
+                         dict([(k, len(v)) for k, v in skipped.items()]), message)
+
+    def testSamples(self):
+      for path, lines in self.logs:
+        for configuration in self.configurations:
+          self.compare(path, lines, configuration)
+
+    def testFaultyLogIssues(self):
+      # All the kinds of issues are found in the faulty logs
+      for (clean, lines), (path, lines) in zip(self.logs[0::2], self.logs[1::2]):
+        original = br.parseLogDrives(clean, True, False, False, False, False, True, True)[0]
+        drives = br.parseLogDrives(path, True, False, False, False, False, True, True)
+        self.assertEqual(len(drives), 3)
+        self.assertEqual(len(drives[0].skipped["H"]), len(original.skipped["H"])+4)
+        self.assertEqual(len(drives[0].skipped["O"]), len(original.skipped["O"])+2)
+
+if __name__ == "__main__":
+    unittest.main()
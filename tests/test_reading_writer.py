@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# Buffered database writer (ReadingWriter) on an in-process collection
+import os, sys, unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bgeigie_report as br
+import fake_mongo
+
+samplesFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples")
+sampleLogs = ["102-0329.LOG", "103-0307.LOG", "103-0314.LOG"]
+
+class ReadingWriterTest(unittest.TestCase):
+    def setUp(self):
+      br.logCacheEnabled = False
+      br.summaryStoreEnabled = False
+      self.collection = fake_mongo.Collection()
+
+    def tearDown(self):
+      br.dbWriter = None
+      br.summaryStoreEnabled = True
+
+    def drive(self, name):
+      return br.parseLogDrives(os.path.join(samplesFolder, name), True, False, False, False, False, False, False)[0]
+
+    def testBatches(self):
+      # Full batches, then the partial one when flushed
+      drive = self.drive("103-0307.LOG")
+      writer = br.ReadingWriter(self.collection, batchSize = 500)
+      writer.write(drive, "tag", "103-0307.LOG")
+      full, partial = divmod(len(drive), 500)
+      self.assertTrue(full > 1 and partial > 0)
+      self.assertEqual(self.collection.calls, [("insert", 500)]*full)
+      writer.flush()
+      self.assertEqual(self.collection.calls, [("insert", 500)]*full + [("insert", partial)])
+      self.assertEqual(writer.count, len(drive))
+      writer.flush()
+      self.assertEqual(len(self.collection.calls), full+1)
+
+    def testDocuments(self):
+      # Same fields as the original loader, date as written in the log
+      drive = self.drive("102-0329.LOG")
+      writer = br.ReadingWriter(self.collection, batchSize = 100)
+      writer.write(drive, "tag", "102-0329.LOG")
+      writer.close()
+      self.assertEqual(len(self.collection.documents), len(drive))
+      with open(os.path.join(samplesFolder, "102-0329.LOG")) as f:
+        logDates = set([l.split(",")[2] for l in f if l.startswith("$")])
+      dates = [d["date"] for d in self.collection.documents]
+      self.assertEqual(dates, [datetime.utcfromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%SZ') for t in drive.time.tolist()])
+      self.assertTrue(set(dates) <= logDates)
+      document = self.collection.documents[0]
+      self.assertEqual(document["drive"], drive.drive[0])
+      self.assertEqual((document["tag"], document["log"]), ("tag", "102-0329.LOG"))
+      self.assertEqual(document["loc"], [drive.lat[0], drive.lon[0]])
+      self.assertEqual((document["cpm"], document["altitude"]), (drive.cpm[0], drive.altitude[0]))
+
+    @unittest.skipIf(not br.dbSupport, "pymongo not installed")
+    def testIndexesOnce(self):
+      # All the logs written by the shared writer, the indexes built at the end
+      br.dbWriter = br.ReadingWriter(self.collection, batchSize = 1000)
+      total = 0
+      for name in sampleLogs:
+        for segment, drive in br.loadLogSegments(os.path.join(samplesFolder, name), True, False, False, False, "tag", False):
+          total += len(drive)
+      self.assertEqual(self.collection.indexes, [])
+      br.closeDbWriter()
+      self.assertEqual(len(self.collection.indexes), 2)
+      self.assertEqual(sum([n for call, n in self.collection.calls]), total)
+      self.assertTrue(all([n <= 1000 for call, n in self.collection.calls]))
+      self.assertEqual(len(self.collection.documents), total)
+
+if __name__ == "__main__":
+    unittest.main()
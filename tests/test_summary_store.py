@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Persistent per cell summary (SummaryStore) fed by loadLogSegments, on an
+# in-process collection
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bgeigie_report as br
+import fake_mongo
+
+samplesFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "samples")
+
+@unittest.skipIf(not br.dbSupport, "pymongo not installed")
+class SummaryStoreTest(unittest.TestCase):
+    def setUp(self):
+      self.folder = tempfile.mkdtemp()
+      self.db = fake_mongo.Database()
+      br.dbWriter = br.ReadingWriter(fake_mongo.Collection())
+      br.summaryStore = br.SummaryStore(self.db)
+      br.summaryStoreEnabled = True
+      br.logCacheEnabled = False
+
+    def tearDown(self):
+      br.dbWriter = None
+      br.summaryStore = None
+      shutil.rmtree(self.folder)
+
+    def copy(self, sample, folder, name):
+      path = os.path.join(self.folder, folder, name)
+      if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+      shutil.copy(os.path.join(samplesFolder, sample), path)
+      return path
+
+    def load(self, path, worldMode = False, instantCPM = False):
+      br.loadLogSegments(path, True, worldMode, False, False, "test", instantCPM)
+
+    def cells(self):
+      return sorted([(c["_id"], c["count"], round(c["sum"], 9), c["max"]) for c in self.db.cells.documents])
+
+    def expectedCells(self, paths):
+      # Cells of the logs parsed with the summary options
+      drives = []
+      for path in paths:
+        drives += br.parseLogDrives(path, *br.summaryParameters)
+      drive = br.concatenateDrives(drives, sum([len(d) for d in drives]))
+      return sorted([("%d:%d" % (y, x), count, round(total, 9), maximum)
+                     for y, x, count, total, maximum in zip(*[c.tolist() for c in br.summaryCells(drive)])])
+
+    def testSameLogTwice(self):
+      # Counted once whatever its name and the options of the report
+      path = self.copy("102-0329.LOG", "a", "102-0329.LOG")
+      self.load(path)
+      cells = self.cells()
+      self.assertEqual(cells, self.expectedCells([path]))
+      self.load(path, worldMode = True, instantCPM = True)
+      self.load(self.copy("102-0329.LOG", "b", "renamed.LOG"))
+      self.assertEqual(self.cells(), cells)
+      self.assertEqual(len(self.db.summaryLogs.documents), 1)
+
+    def testSummaryOptions(self):
+      # The report options don't change the stored values
+      path = self.copy("103-0307.LOG", "a", "103-0307.LOG")
+      self.load(path, worldMode = True, instantCPM = True)
+      self.assertEqual(self.cells(), self.expectedCells([path]))
+
+    def testSameName(self):
+      # Two different logs with the same name are both kept
+      first = self.copy("102-0329.LOG", "2013", "102-0329.LOG")
+      second = self.copy("103-0314.LOG", "2014", "102-0329.LOG")
+      self.load(first)
+      self.load(second)
+      self.assertEqual(self.cells(), self.expectedCells([first, second]))
+      self.assertEqual(len(self.db.summaryLogs.documents), 2)
+      self.assertEqual(br.summaryStore.statistics()["points"],
+                       sum([len(d) for p in (first, second) for d in br.parseLogDrives(p, *br.summaryParameters)]))
+
+    def testRemove(self):
+      # Removing a log gives the cells of the other ones
+      first = self.copy("103-0307.LOG", "a", "103-0307.LOG")
+      second = self.copy("103-0314.LOG", "a", "103-0314.LOG")
+      self.load(first)
+      self.load(second)
+      br.summaryStore.remove(br.logContentKey(first))
+      cells = self.cells()
+      expected = self.expectedCells([second])
+      self.assertEqual([c[:2] for c in cells], [c[:2] for c in expected])
+      for c, e in zip(cells, expected):
+        self.assertAlmostEqual(c[2], e[2], 6)
+        self.assertEqual(c[3], e[3])
+
+    def testBulkUpdate(self):
+      # One bulk operation for all the cells of a log
+      path = self.copy("103-0314.LOG", "a", "103-0314.LOG")
+      self.load(path)
+      self.assertEqual(self.db.cells.calls, [("bulk", len(self.db.cells.documents))])
+
+if __name__ == "__main__":
+    unittest.main()
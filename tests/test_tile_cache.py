@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# SQLite tile cache: least recently used tiles removed past the size and count
+# limits, the tiles used by a map marked in one batch
+import os, sys, shutil, tempfile, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bgeigie_report as br
+
+class CountingConnection:
+    # sqlite3 connection counting the commits and the statements
+    def __init__(self, db):
+      self.db = db
+      self.commits = 0
+      self.statements = 0
+
+    def commit(self):
+      self.commits += 1
+      self.db.commit()
+
+    def execute(self, *args):
+      self.statements += 1
+      return self.db.execute(*args)
+
+    def executemany(self, *args):
+      self.statements += 1
+      return self.db.executemany(*args)
+
+    def __getattr__(self, name):
+      return getattr(self.db, name)
+
+class TileSource:
+    cached = True
+
+    def __init__(self):
+      self.requests = []
+
+    def fetchAll(self, zoom, tiles):
+      self.requests += tiles
+      return ["tile %d/%d/%d" % (zoom, x, y) for x, y in tiles]
+
+class TileCacheTest(unittest.TestCase):
+    def setUp(self):
+      self.folder = tempfile.mkdtemp()
+      self.cache = br.TileCache(os.path.join(self.folder, "tiles", "tiles.mbtiles"), maxSize = 10**9, maxCount = 0, expiry = 0)
+
+    def tearDown(self):
+      self.cache.close()
+      br.tileCache = None
+      br.tileSourceInstance = None
+      shutil.rmtree(self.folder)
+
+    def fill(self, count, size = 10):
+      # Tiles (x, 0) used from the oldest (x = 0) to the most recent one
+      self.cache.put([(5, x, 0, "t"*size) for x in range(count)])
+      self.cache.db.executemany("UPDATE tiles SET accessed=? WHERE tile_column=?", [(1000+x, x) for x in range(count)])
+      self.cache.db.commit()
+
+    def columns(self):
+      return sorted([r[0] for r in self.cache.db.execute("SELECT tile_column FROM tiles")])
+
+    def testCountLimit(self):
+      self.fill(10)
+      self.cache.maxCount = 10
+      self.cache.touch(5, [(0, 0), (1, 0)])
+      self.cache.put([(5, x, 1, "n") for x in range(20, 25)])
+      self.assertEqual(self.columns(), [0, 1, 7, 8, 9, 20, 21, 22, 23, 24])
+
+    def testSizeLimit(self):
+      self.fill(3, size = 30)
+      self.cache.maxSize = 100
+      self.cache.touch(5, [(0, 0)])
+      self.cache.put([(5, 10, 0, "n"*30)])
+      self.assertEqual(self.columns(), [0, 2, 10])
+      self.cache.put([(5, 11, 0, "n"*40)])
+      self.assertEqual(self.columns(), [0, 10, 11])
+      self.assertEqual(self.cache.get(5, 1, 0), None)
+
+    def testDownloadTiles(self):
+      # Cached tiles re-used and marked in one statement before the new ones
+      # are stored, so they are not evicted by them
+      self.fill(4)
+      self.cache.maxCount = 4
+      source = TileSource()
+      br.tileCache = self.cache
+      br.tileSourceInstance = (os.getpid(), source)
+      self.cache.db = CountingConnection(self.cache.db)
+      data = br.downloadTiles(5, [(0, 0), (1, 0), (10, 0), (11, 0)])
+      self.assertEqual(data, ["t"*10, "t"*10, "tile 5/10/0", "tile 5/11/0"])
+      self.assertEqual(source.requests, [(10, 0), (11, 0)])
+      self.assertEqual(self.columns(), [0, 1, 10, 11])
+      self.assertEqual(self.cache.db.commits, 3) # touch, put, evict
+
+      # Only the reads and one update when all the tiles are cached
+      self.cache.db.commits = self.cache.db.statements = 0
+      tiles = [(0, 0), (1, 0), (10, 0), (11, 0)]
+      br.downloadTiles(5, tiles)
+      self.assertEqual((self.cache.db.commits, self.cache.db.statements), (1, len(tiles)+1))
+      self.assertEqual(len(source.requests), 2)
+
+if __name__ == "__main__":
+    unittest.main()
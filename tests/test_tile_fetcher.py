@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Tile downloads against a local HTTP server: connections kept alive,
+# results in the order of the requests, missing and slow tiles
+import os, sys, time, threading, unittest, BaseHTTPServer, SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import bgeigie_report as br
+
+# -----------------------------------------------------------------------------
+# Local tile server
+# -----------------------------------------------------------------------------
+class TileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive
+
+    def setup(self):
+      BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+      with self.server.lock:
+        self.server.connections += 1
+
+    def do_GET(self):
+      with self.server.lock:
+        self.server.requests[self.path] = self.server.requests.get(self.path, 0) + 1
+        count = self.server.requests[self.path]
+      status, body = 200, "tile " + self.path
+      if self.path.startswith("/missing"):
+        status, body = 404, "not found"
+      elif self.path.startswith("/slow"):
+        time.sleep(1.0)
+      elif self.path.startswith("/busy") and count == 1:
+        status, body = 503, "busy"
+      elif self.path.startswith("/tiles/"):
+        # The last tiles are answered first
+        time.sleep(0.002*(40-int(self.path.split("/")[-1])))
+      self.send_response(status)
+      self.send_header("Content-Type", "application/octet-stream")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      pass
+
+class TileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+      BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), TileHandler)
+      self.lock = threading.Lock()
+      self.connections = 0
+      self.requests = {}
+
+    def handle_error(self, request, client_address):
+      pass # client gone after a timeout
+
+class CountingFetcher(br.TileFetcher):
+    def __init__(self, *args, **kwargs):
+      br.TileFetcher.__init__(self, *args, **kwargs)
+      self.opened = 0
+
+    def connect(self, scheme, netloc):
+      with self.lock:
+        self.opened += 1
+      return br.TileFetcher.connect(self, scheme, netloc)
+
+# -----------------------------------------------------------------------------
+# Tests
+# -----------------------------------------------------------------------------
+class TileFetcherTest(unittest.TestCase):
+    def setUp(self):
+      self.server = TileServer()
+      self.thread = threading.Thread(target=self.server.serve_forever)
+      self.thread.daemon = True
+      self.thread.start()
+      self.base = "http://127.0.0.1:%d" % self.server.server_address[1]
+
+    def tearDown(self):
+      self.server.shutdown()
+      self.server.server_close()
+
+    def urls(self, count):
+      return ["%s/tiles/%d" % (self.base, i) for i in range(count)]
+
+    def testKeepAlive(self):
+      # One connection reused for all the tiles
+      fetcher = CountingFetcher(workers=1, hostConnections=1, timeout=5, retries=0)
+      urls = self.urls(20)
+      self.assertEqual(fetcher.fetchAll(urls), ["tile /tiles/%d" % i for i in range(20)])
+      fetcher.close()
+      self.assertEqual(fetcher.opened, 1)
+      self.assertEqual(self.server.connections, 1)
+
+    def testOrder(self):
+      # Results in the order of the urls, at most hostConnections connections
+      fetcher = CountingFetcher(workers=8, hostConnections=4, timeout=5, retries=0)
+      urls = self.urls(40)
+      self.assertEqual(fetcher.fetchAll(urls), ["tile /tiles/%d" % i for i in range(40)])
+      fetcher.close()
+      self.assertTrue(1 <= fetcher.opened <= 4, fetcher.opened)
+      self.assertEqual(sum(self.server.requests.values()), 40)
+
+    def testMissing(self):
+      # No retry of a missing tile
+      fetcher = br.TileFetcher(workers=2, hostConnections=2, timeout=5, retries=2, retryDelay=0.01)
+      result = fetcher.fetchAll([self.base + "/missing/1", self.base + "/tiles/1"])
+      fetcher.close()
+      self.assertEqual(result, [None, "tile /tiles/1"])
+      self.assertEqual(self.server.requests["/missing/1"], 1)
+
+    def testRetry(self):
+      # Server errors are retried
+      fetcher = br.TileFetcher(workers=1, hostConnections=1, timeout=5, retries=2, retryDelay=0.01)
+      self.assertEqual(fetcher.fetch(self.base + "/busy/1"), "tile /busy/1")
+      fetcher.close()
+      self.assertEqual(self.server.requests["/busy/1"], 2)
+
+    def testTimeout(self):
+      fetcher = br.TileFetcher(workers=2, hostConnections=2, timeout=0.2, retries=1, retryDelay=0.01)
+      start = time.time()
+      result = fetcher.fetchAll([self.base + "/slow/1", self.base + "/tiles/2"])
+      fetcher.close()
+      self.assertEqual(result, [None, "tile /tiles/2"])
+      self.assertEqual(self.server.requests["/slow/1"], 2)
+      self.assertTrue(time.time()-start < 1.5)
+
+if __name__ == "__main__":
+    unittest.main()